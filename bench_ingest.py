@@ -0,0 +1,162 @@
+import argparse
+import asyncio
+import json
+import statistics
+import time
+import httpx
+from telegram import Update
+from telegram.ext import Application, TypeHandler
+from telegram.request import BaseRequest
+
+# Local benchmark of update ingestion: feeds the same stream of updates to the bot in polling mode and in webhook mode
+# and reports how long each update took from reaching "Telegram" to its handler running. A fake Bot API stands in for
+# Telegram, with --latency added to every hop between it and the bot so the numbers resemble a real network.
+# Usage: python bench_ingest.py [--updates 500] [--rate 50] [--latency 40] [--mode both]
+WEBHOOK_PORT = 8765
+WEBHOOK_PATH = 'telegram'
+WEBHOOK_SECRET = 'bench-secret'
+
+
+class FakeBotApi(BaseRequest):
+    def __init__(self, latency):
+        self.latency = latency  # one way, in seconds
+        self.updates = []
+        self.arrived = asyncio.Event()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def push(self, update):
+        self.updates.append(update)
+        self.arrived.set()
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        await asyncio.sleep(self.latency)  # request on its way to Telegram
+
+        if endpoint == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Haley', 'username': 'haley_bench_bot'}
+        elif endpoint == 'getUpdates':
+            result = await self.get_updates(int(params.get('offset', 0)), float(params.get('timeout', 0)))
+        else:
+            result = True
+
+        await asyncio.sleep(self.latency)  # response on its way back
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+    async def get_updates(self, offset, timeout):
+        # Long poll: answer as soon as there is anything at or after offset, or when timeout runs out
+        self.updates = [update for update in self.updates if update['update_id'] >= offset]
+        deadline = asyncio.get_running_loop().time() + timeout
+        while not self.updates:
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                break
+            self.arrived.clear()
+            try:
+                await asyncio.wait_for(self.arrived.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+        return list(self.updates)
+
+
+def fake_update(update_id):
+    chat = {'id': 1000 + update_id % 50, 'type': 'private', 'first_name': 'Bench'}
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': chat,
+            'from': {'id': chat['id'], 'is_bot': False, 'first_name': 'Bench'},
+            'text': 'hello',
+        },
+    }
+
+
+async def bench(mode, args):
+    api = FakeBotApi(args.latency / 1000)
+    sent = {}
+    latencies = []
+    done = asyncio.Event()
+
+    async def record(update, context):
+        latencies.append(time.perf_counter() - sent[update.update_id])
+        if len(latencies) == args.updates:
+            done.set()
+
+    application = Application.builder().token('1:bench').request(api).get_updates_request(api).build()
+    application.add_handler(TypeHandler(Update, record))
+
+    async with application:
+        await application.start()
+        if mode == 'polling':
+            await application.updater.start_polling(poll_interval=0, timeout=10)
+        else:
+            await application.updater.start_webhook(listen='127.0.0.1', port=WEBHOOK_PORT, url_path=WEBHOOK_PATH,
+                                                    secret_token=WEBHOOK_SECRET)
+
+        async with httpx.AsyncClient() as client:
+            # Telegram keeps at most max_connections webhook requests in flight
+            connections = asyncio.Semaphore(40)
+
+            async def deliver(update):
+                async with connections:
+                    await asyncio.sleep(api.latency)
+                    await client.post(f'http://127.0.0.1:{WEBHOOK_PORT}/{WEBHOOK_PATH}', json=update,
+                                      headers={'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET})
+
+            deliveries = []
+            for update_id in range(1, args.updates + 1):
+                update = fake_update(update_id)
+                sent[update_id] = time.perf_counter()
+                if mode == 'polling':
+                    api.push(update)
+                else:
+                    deliveries.append(asyncio.create_task(deliver(update)))
+                await asyncio.sleep(1 / args.rate)
+
+            try:
+                await asyncio.wait_for(done.wait(), 30)
+            except asyncio.TimeoutError:
+                print(f"{mode}: only {len(latencies)} of {args.updates} updates handled")
+            await asyncio.gather(*deliveries)
+
+        await application.updater.stop()
+        await application.stop()
+
+    return latencies
+
+
+def report(mode, latencies):
+    if not latencies:
+        print(f"{mode:>8}: no updates handled")
+        return
+    ms = sorted(latency * 1000 for latency in latencies)
+    p95 = ms[int(len(ms) * 0.95) - 1]
+    p99 = ms[int(len(ms) * 0.99) - 1]
+    print(f"{mode:>8}: n={len(ms)}  mean={statistics.mean(ms):.1f}ms  p50={statistics.median(ms):.1f}ms"
+          f"  p95={p95:.1f}ms  p99={p99:.1f}ms  max={ms[-1]:.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare update latency under polling and webhook modes")
+    parser.add_argument('--updates', type=int, default=500)
+    parser.add_argument('--rate', type=float, default=50, help="updates per second")
+    parser.add_argument('--latency', type=float, default=40, help="one way latency to Telegram, in ms")
+    parser.add_argument('--mode', choices=['polling', 'webhook', 'both'], default='both')
+    args = parser.parse_args()
+
+    modes = ['polling', 'webhook'] if args.mode == 'both' else [args.mode]
+    print(f"{args.updates} updates at {args.rate:g}/s, {args.latency:g}ms each way to Telegram")
+    for mode in modes:
+        report(mode, asyncio.run(bench(mode, args)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,25 @@
+import asyncio
+import hashlib
+import json
 import logging
 import re
 import os
+import threading
+import time
+import uuid
 import mysql.connector
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from mysql.connector import Error
-from telegram.ext import (Application, CommandHandler, MessageHandler, ConversationHandler, CallbackQueryHandler,
-                          CallbackContext, filters)
-from datetime import datetime, timedelta
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Bot, ReplyKeyboardMarkup
+from mysql.connector.errors import PoolError
+from telegram.ext import (Application, BasePersistence, BaseUpdateProcessor, CommandHandler, MessageHandler,
+                          ConversationHandler, CallbackQueryHandler, CallbackContext, ChatMemberHandler,
+                          PersistenceInput, TypeHandler, filters)
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Bot, ReplyKeyboardMarkup, Update
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
 
 # 6th commit
 
@@ -32,24 +44,572 @@ ASSOC_CHAT_ID = os.getenv('ASSOC_CHAT_ID')
 (COMPLETE_OR_CANCEL, ANY_REMOVALS, CONFIRM_ALL_PROG_DEETS) = range(3)
 
 
+# DB CONNECTION POOL
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '10'))  # Seconds to wait for a free connection
+DB_POOL_PING_AFTER = float(os.getenv('DB_POOL_PING_AFTER', '30'))  # Ping connections idle longer than this
+DB_SESSION_SETUP = [
+    "SET time_zone = '+08:00'",
+]
+
+
+class PooledConnection:
+    # Handed out by the pool. Behaves like a normal connection, but close() gives it back to the pool
+    def __init__(self, pool, connection):
+        self._pool = pool
+        self._connection = connection
+
+    def __getattr__(self, name):
+        if self._connection is None:
+            raise Error("Connection has already been returned to the pool")
+        return getattr(self._connection, name)
+
+    def cursor(self, *args, **kwargs):
+        # Buffered, so a result read with fetchone() is never left unread. An unbuffered cursor with rows left over
+        # raises "Unread result found" from close(), and helpers would then skip handing the connection back.
+        kwargs.setdefault('buffered', True)
+        return self.__getattr__('cursor')(*args, **kwargs)
+
+    def close(self):
+        if self._connection is not None:
+            connection, self._connection = self._connection, None
+            self._pool.release(connection)
+
+
+class ConnectionPool:
+    def __init__(self, size, timeout, ping_after, session_setup, **connect_args):
+        self.size = size
+        self.timeout = timeout
+        self.ping_after = ping_after
+        self.session_setup = session_setup
+        self.connect_args = connect_args
+        self._idle = deque()  # (connection, last_returned) pairs, most recently used on the right
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+        self._in_use = 0
+        self._calls = threading.local()  # .checked_out: MySQL connection ids held by the thread's current run_db call
+        self._stats = {
+            'connections_created': 0,
+            'connections_discarded': 0,
+            'checkouts': 0,
+            'checkout_waits': 0,
+            'checkout_wait_seconds': 0.0,
+            'checkout_timeouts': 0,
+            'health_check_failures': 0,
+        }
+
+    def _new_connection(self):
+        connection = mysql.connector.connect(**self.connect_args)
+        cursor = connection.cursor()
+        try:
+            for statement in self.session_setup:
+                cursor.execute(statement)
+        finally:
+            cursor.close()
+        print("Connected to MySQL Server version ", connection.get_server_info())
+        with self._lock:
+            self._stats['connections_created'] += 1
+        return connection
+
+    def _discard(self, connection):
+        with self._lock:
+            self._stats['connections_discarded'] += 1
+        try:
+            connection.close()
+        except Error:
+            pass
+
+    def _healthy(self, connection, last_returned):
+        # Only pay for a ping when the connection has sat idle long enough to have been dropped by the server
+        if time.monotonic() - last_returned < self.ping_after:
+            return True
+        try:
+            connection.ping(reconnect=False)
+            return True
+        except Error:
+            with self._lock:
+                self._stats['health_check_failures'] += 1
+            return False
+
+    def get_connection(self):
+        started = time.monotonic()
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._stats['checkout_waits'] += 1
+            if not self._slots.acquire(timeout=self.timeout):
+                with self._lock:
+                    self._stats['checkout_timeouts'] += 1
+                raise PoolError("Failed getting connection; pool exhausted")
+            with self._lock:
+                self._stats['checkout_wait_seconds'] += time.monotonic() - started
+
+        try:
+            while True:
+                with self._lock:
+                    idle = self._idle.pop() if self._idle else None
+                if idle is None:
+                    connection = self._new_connection()
+                    break
+                connection, last_returned = idle
+                if self._healthy(connection, last_returned):
+                    break
+                self._discard(connection)
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self._stats['checkouts'] += 1
+            self._in_use += 1
+        checked_out = getattr(self._calls, 'checked_out', None)
+        if checked_out is not None:
+            checked_out.add(connection.connection_id)
+        return PooledConnection(self, connection)
+
+    def release(self, connection):
+        with self._lock:
+            self._in_use -= 1
+        checked_out = getattr(self._calls, 'checked_out', None)
+        if checked_out is not None:
+            checked_out.discard(connection.connection_id)
+        try:
+            # Never hand an open transaction (or its read snapshot) to the next caller
+            if connection.in_transaction:
+                connection.rollback()
+            with self._lock:
+                self._idle.append((connection, time.monotonic()))
+        except Error:
+            self._discard(connection)
+        finally:
+            self._slots.release()
+
+    def track_checkouts(self, checked_out):
+        # Until called again with None, connections this thread checks out are added to checked_out while it holds them
+        self._calls.checked_out = checked_out
+
+    def kill_query(self, connection_id, still_running=None):
+        # Uses its own short-lived connection, the pool may well be exhausted by the query we are killing. Connecting
+        # takes a while, so still_running() is asked again once connected: by then the connection may have been handed
+        # back and checked out for someone else's query.
+        try:
+            connection = mysql.connector.connect(**self.connect_args)
+        except Error as e:
+            print("Error while connecting to MySQL to cancel a query", e)
+            return
+        try:
+            if still_running is not None and not still_running():
+                return
+            cursor = connection.cursor()
+            cursor.execute(f"KILL QUERY {int(connection_id)}")
+            cursor.close()
+        except Error as e:
+            print("Error while cancelling query", e)
+        finally:
+            connection.close()
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['idle'] = len(self._idle)
+            stats['in_use'] = self._in_use
+        stats['size'] = self.size
+        return stats
+
+
+db_pool = ConnectionPool(
+    size=DB_POOL_SIZE,
+    timeout=DB_POOL_TIMEOUT,
+    ping_after=DB_POOL_PING_AFTER,
+    session_setup=DB_SESSION_SETUP,
+    host=os.getenv('DB_HOST'),
+    database=os.getenv('DB_DATABASE'),
+    user=os.getenv('DB_USERNAME'),
+    password=os.getenv('DB_PASSWORD'),
+)
+
+
 # MAIN DB CONNECTOR
 def create_db_connection():
     try:
-        connection = mysql.connector.connect(
-            host=os.getenv('DB_HOST'),
-            database=os.getenv('DB_DATABASE'),
-            user=os.getenv('DB_USERNAME'),
-            password=os.getenv('DB_PASSWORD')
-        )
-        if connection.is_connected():
-            db_info = connection.get_server_info()
-            print("Connected to MySQL Server version ", db_info)
-            return connection
+        return db_pool.get_connection()
     except Error as e:
         print("Error while connecting to MySQL", e)
         return None
 
 
+# ASYNC DB ACCESS
+# mysql-connector blocks, so every DB helper is run on this executor instead of the event loop. One worker per pooled
+# connection means a worker never has to wait on the pool.
+DB_QUERY_TIMEOUT = float(os.getenv('DB_QUERY_TIMEOUT', '15'))
+db_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix='db')
+
+
+async def run_db(func, *args, timeout=None):
+    loop = asyncio.get_running_loop()
+    # Connections this call holds right now, recorded with the call rather than its worker thread: by the time it
+    # times out the thread may have moved on to someone else's query
+    checked_out = set()
+
+    def call():
+        db_pool.track_checkouts(checked_out)
+        try:
+            return func(*args)
+        finally:
+            db_pool.track_checkouts(None)
+            checked_out.clear()
+
+    def cancel(connection_id):
+        db_pool.kill_query(connection_id, lambda: connection_id in checked_out)
+
+    try:
+        return await asyncio.wait_for(loop.run_in_executor(db_executor, call),
+                                      timeout if timeout is not None else DB_QUERY_TIMEOUT)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        # The worker thread can't be interrupted from here, so ask MySQL to abort whatever it is running
+        for connection_id in checked_out.copy():
+            logger.warning(f"Cancelling {func.__name__} (MySQL connection {connection_id})")
+            loop.run_in_executor(None, cancel, connection_id)
+        raise
+
+
+# UNIT OF WORK
+class UnitOfWork:
+    # One pooled connection and one transaction for everything inside the with block. Commits once on the way out,
+    # rolls everything back if anything in the block raised.
+    def __init__(self):
+        self.connection = None
+        self.cursor = None
+        self.commit_hooks = []
+
+    def on_commit(self, func):
+        # Runs func once the transaction has committed, eg. to invalidate a cache
+        self.commit_hooks.append(func)
+
+    def __enter__(self):
+        self.connection = db_pool.get_connection()
+        self.cursor = self.connection.cursor()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                self.connection.commit()
+            else:
+                self.connection.rollback()
+        finally:
+            try:
+                self.cursor.close()
+            finally:
+                self.connection.close()
+        if exc_type is None:
+            for func in self.commit_hooks:
+                func()
+        return False
+
+
+# ROW MODELS
+# Rows from jobs, applications, users and the hours ledger are decoded once into these rather than indexed as tuples.
+# Columns are matched by name (cursor.column_names), so a query may select any of a model's columns in any order;
+# the rest are None. Dates and times are formatted the first time they are shown and kept on the row.
+def format_time(value):
+    # TIME columns come back as a timedelta since midnight
+    if isinstance(value, timedelta):
+        return (datetime.min + value).strftime('%I:%M %p')
+    return str(value)
+
+
+class Row:
+    __slots__ = ()
+    fields = ()
+
+    def __init_subclass__(cls):
+        super().__init_subclass__()
+        cls.fields = cls.fields + cls.__dict__.get('__slots__', ())
+
+    def __init__(self, **values):
+        for name in self.fields:
+            setattr(self, name, values.get(name))
+
+    @classmethod
+    def from_row(cls, columns, row):
+        obj = cls.__new__(cls)
+        for name in cls.fields:
+            setattr(obj, name, None)
+        for name, value in zip(columns, row):
+            setattr(obj, name, value)
+        return obj
+
+    @classmethod
+    def one(cls, cursor):
+        row = cursor.fetchone()
+        return cls.from_row(cursor.column_names, row) if row else None
+
+    @classmethod
+    def all(cls, cursor):
+        columns = cursor.column_names
+        return [cls.from_row(columns, row) for row in cursor.fetchall()]
+
+
+class ProgrammeRow(Row):
+    # The programme's columns, which applications and the hours ledger carry or join in too
+    __slots__ = ('session_id', 'chat_id', 'programme_name', 'school', 'prog_date', 'start_time', 'hours',
+                 'student_level', '_date_text', '_date_digits', '_time_text')
+
+    @property
+    def date_text(self):
+        # '04 Jan 23'
+        if self._date_text is None:
+            self._date_text = self.prog_date.strftime('%d %b %y')
+        return self._date_text
+
+    @property
+    def date_digits(self):
+        # '04-01-23'
+        if self._date_digits is None:
+            self._date_digits = self.prog_date.strftime('%d-%m-%y')
+        return self._date_digits
+
+    @property
+    def time_text(self):
+        # '09:15 AM'
+        if self._time_text is None:
+            self._time_text = format_time(self.start_time)
+        return self._time_text
+
+
+class Job(ProgrammeRow):
+    __slots__ = ('trainers_needed', 'job_status')
+
+
+class JobApplication(ProgrammeRow):
+    __slots__ = ('uid', 'telegram_id', 'first_name', 'last_name', 'mobile', 'postal', 'app_status', 'apply_time')
+
+
+class HoursEntry(ProgrammeRow):
+    __slots__ = ('entry_id', 'credited_at', 'note')
+
+    @property
+    def credited_text(self):
+        return self.credited_at.strftime('%d %b %y')
+
+
+class User(Row):
+    __slots__ = ('uid', 'telegram_id', 'first_name', 'last_name', 'date_of_birth', 'nric_number', 'moe_irs', 'mobile',
+                 'postal', 'total_hours')
+
+
+# BACKGROUND TASKS
+periodic_jobs = []  # (interval, coroutine function) pairs, started with the application
+background_tasks = []
+
+
+def run_every(interval, func):
+    periodic_jobs.append((interval, func))
+
+
+async def run_periodically(interval, func):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await func()
+        except Exception as e:
+            logger.error(f"Error in background job {getattr(func, '__name__', func)}: {e}")
+
+
+# NOTIFICATION DISPATCHER
+# Telegram allows roughly 30 messages a second overall and about 1 a second into the same chat
+NOTIFY_GLOBAL_RATE = float(os.getenv('NOTIFY_GLOBAL_RATE', '25'))
+NOTIFY_CHAT_RATE = float(os.getenv('NOTIFY_CHAT_RATE', '1'))
+NOTIFY_WORKERS = int(os.getenv('NOTIFY_WORKERS', '8'))
+NOTIFY_MAX_RETRIES = int(os.getenv('NOTIFY_MAX_RETRIES', '3'))
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = asyncio.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        # Waiters queue up on the lock, so tokens are handed out first come first served
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def idle(self):
+        self._refill(time.monotonic())
+        return not self.lock.locked() and self.tokens >= self.capacity
+
+
+class NotificationBatch:
+    def __init__(self, total, on_complete=None):
+        self.total = total
+        self.on_complete = on_complete
+        self.delivered = []
+        self.failed = []
+
+    def record(self, label, delivered):
+        (self.delivered if delivered else self.failed).append(label)
+        if self.on_complete is not None and len(self.delivered) + len(self.failed) == self.total:
+            asyncio.create_task(self.on_complete(self))
+
+
+class NotificationDispatcher:
+    def __init__(self, global_rate, chat_rate, workers, max_retries):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.workers = workers
+        self.max_retries = max_retries
+        self.bot = None
+        self.queue = None
+        self.tasks = []
+        self.global_bucket = None
+        self.chat_buckets = {}
+
+    async def start(self, bot):
+        self.bot = bot
+        self.queue = asyncio.Queue()
+        self.global_bucket = TokenBucket(self.global_rate)
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout=10):
+        # Give queued messages a chance to go out before the workers are torn down
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Dropping {self.queue.qsize()} queued notification(s) on shutdown")
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    def send_batch(self, messages, on_complete=None):
+        # messages are (chat_id, text, label) tuples. Returns straight away, on_complete(batch) runs once every
+        # message has either been delivered or given up on.
+        batch = NotificationBatch(len(messages), on_complete)
+        for message in messages:
+            self.queue.put_nowait((message, batch))
+        return batch
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 1000:
+                self.chat_buckets = {key: value for key, value in self.chat_buckets.items() if not value.idle()}
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate)
+        return bucket
+
+    async def _deliver(self, chat_id, text):
+        for attempt in range(self.max_retries + 1):
+            await self._chat_bucket(chat_id).acquire()
+            await self.global_bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=text)
+                return True
+            except RetryAfter as e:
+                # Flood control applies to the whole bot, so hold everyone back, not just this chat
+                logger.warning(f"Flood limit hit, pausing notifications for {e.retry_after}s")
+                self.global_bucket.pause(e.retry_after)
+            except (Forbidden, BadRequest) as e:
+                logger.warning(f"Could not notify {chat_id}: {e}")
+                return False
+            except NetworkError as e:
+                logger.warning(f"Network error notifying {chat_id}, retrying: {e}")
+                await asyncio.sleep(2 ** attempt)
+        return False
+
+    async def _worker(self):
+        while True:
+            (chat_id, text, label), batch = await self.queue.get()
+            delivered = False
+            try:
+                delivered = await self._deliver(chat_id, text)
+            except Exception as e:
+                logger.error(f"Error sending notification to {chat_id}: {e}")
+            finally:
+                batch.record(label, delivered)
+                self.queue.task_done()
+
+
+notifier = NotificationDispatcher(NOTIFY_GLOBAL_RATE, NOTIFY_CHAT_RATE, NOTIFY_WORKERS, NOTIFY_MAX_RETRIES)
+
+
+def delivery_reporter(bot, chat_id, what):
+    # Builds an on_complete callback that tells the manager's chat how the batch went
+    async def report(batch):
+        message_report = f"{what}: {len(batch.delivered)} of {batch.total} notified."
+        if batch.failed:
+            message_report += " Couldn't reach UID(s): " + ", ".join(str(label) for label in batch.failed)
+        try:
+            await bot.send_message(chat_id=chat_id, text=message_report)
+        except TelegramError as e:
+            logger.warning(f"Could not send delivery report: {e}")
+    return report
+
+
+# INVITE LINK CACHE
+# Each programme has its own group chat, so one named link per chat is reused for every trainer accepted into it
+INVITE_LINK_TTL = float(os.getenv('INVITE_LINK_TTL', str(7 * 24 * 3600)))
+INVITE_LINK_NAME = "Haley programme link"
+
+
+class InviteLinkCache:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.links = {}  # chat_id -> (invite_link, expires_at)
+        self.locks = {}
+
+    async def get(self, bot, chat_id):
+        entry = self.links.get(chat_id)
+        if entry and entry[1] > time.monotonic():
+            return entry[0]
+
+        # Only one caller per chat goes to Telegram, anyone else arriving meanwhile waits for its link
+        lock = self.locks.setdefault(chat_id, asyncio.Lock())
+        async with lock:
+            entry = self.links.get(chat_id)
+            if entry and entry[1] > time.monotonic():
+                return entry[0]
+            # A named link leaves the group's primary link alone, and expires on Telegram's side a little after we
+            # stop handing it out
+            link = await bot.create_chat_invite_link(
+                chat_id, name=INVITE_LINK_NAME,
+                expire_date=datetime.now(timezone.utc) + timedelta(seconds=self.ttl + 3600))
+            now = time.monotonic()
+            self.links = {key: value for key, value in self.links.items() if value[1] > now}
+            self.links[chat_id] = (link.invite_link, now + self.ttl)
+            return link.invite_link
+
+    async def invalidate(self, bot, chat_id, revoke=False):
+        entry = self.links.pop(chat_id, None)
+        self.locks.pop(chat_id, None)
+        if entry and revoke:
+            try:
+                await bot.revoke_chat_invite_link(chat_id, entry[0])
+            except TelegramError as e:
+                logger.warning(f"Could not revoke invite link for {chat_id}: {e}")
+
+
+invite_links = InviteLinkCache(INVITE_LINK_TTL)
+
+
 # CALLBACK QUERY
 async def handle_callback_query(update, context):
     query = update.callback_query
@@ -121,17 +681,145 @@ async def handle_callback_query(update, context):
         await back_askpostal(update, context)
 
 
+# MEMBERSHIP CACHE
+# Every DM checks that the sender is in the associates group. Answers are kept for a while (misses for less time, so
+# someone who just joined isn't kept waiting) and chat_member updates from the group keep them current.
+MEMBER_CACHE_TTL = float(os.getenv('MEMBER_CACHE_TTL', '3600'))
+MEMBER_NEGATIVE_TTL = float(os.getenv('MEMBER_NEGATIVE_TTL', '60'))
+MEMBER_CACHE_SIZE = int(os.getenv('MEMBER_CACHE_SIZE', '10000'))
+MEMBER_STATUSES = ['member', 'administrator', 'creator']
+
+
+class MembershipCache:
+    def __init__(self, ttl, negative_ttl, max_size):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()  # user_id -> (is_member, expires_at), least recently used first
+
+    def get(self, user_id):
+        entry = self.entries.get(user_id)
+        if entry is None:
+            return None
+        if entry[1] <= time.monotonic():
+            del self.entries[user_id]
+            return None
+        self.entries.move_to_end(user_id)
+        return entry[0]
+
+    def put(self, user_id, is_member):
+        ttl = self.ttl if is_member else self.negative_ttl
+        self.entries[user_id] = (is_member, time.monotonic() + ttl)
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
+membership_cache = MembershipCache(MEMBER_CACHE_TTL, MEMBER_NEGATIVE_TTL, MEMBER_CACHE_SIZE)
+
+
+async def is_associate(bot, user_id):
+    is_member = membership_cache.get(user_id)
+    if is_member is None:
+        member = await bot.get_chat_member(ASSOC_CHAT_ID, user_id)
+        is_member = member.status in MEMBER_STATUSES
+        membership_cache.put(user_id, is_member)
+    return is_member
+
+
+async def track_associate_membership(update, context):
+    # Only the associates group matters here, the bot sits in every programme group too
+    if str(update.chat_member.chat.id) != str(ASSOC_CHAT_ID):
+        return
+    new_member = update.chat_member.new_chat_member
+    membership_cache.put(new_member.user.id, new_member.status in MEMBER_STATUSES)
+
+
+# PHOTO STORE
+# Registration photos live on disk, named by the SHA-256 of their contents so the same picture is only kept once. The
+# users table just holds that hash (photo_ref) and the Telegram file_id.
+PHOTO_STORE_DIR = os.getenv('PHOTO_STORE_DIR', 'photos')
+
+
+class PhotoStore:
+    def __init__(self, root):
+        self.root = root
+
+    def path_for(self, ref):
+        return os.path.join(self.root, ref[:2], ref + '.jpg')
+
+    def exists(self, ref):
+        return os.path.exists(self.path_for(ref))
+
+    def temp_path(self):
+        os.makedirs(os.path.join(self.root, 'tmp'), exist_ok=True)
+        return os.path.join(self.root, 'tmp', uuid.uuid4().hex)
+
+    def put_file(self, temp_path):
+        # Hashes in chunks so a photo is never held in memory in one piece, then moves it to its content address
+        digest = hashlib.sha256()
+        with open(temp_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b''):
+                digest.update(chunk)
+        ref = digest.hexdigest()
+        path = self.path_for(ref)
+        if os.path.exists(path):
+            os.remove(temp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temp_path, path)
+        return ref
+
+    def put_bytes(self, data):
+        temp_path = self.temp_path()
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        return self.put_file(temp_path)
+
+
+photo_store = PhotoStore(PHOTO_STORE_DIR)
+
+
+# PHOTO DELIVERY CACHE
+# uid -> Telegram file_id of that user's photo. Sending a file_id costs no upload, and with it in memory /seephoto
+# doesn't need the DB either.
+PHOTO_FILE_ID_CACHE_SIZE = int(os.getenv('PHOTO_FILE_ID_CACHE_SIZE', '2000'))
+
+
+class LRUCache:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def pop(self, key):
+        return self.entries.pop(key, None)
+
+
+photo_file_ids = LRUCache(PHOTO_FILE_ID_CACHE_SIZE)
+
+
 # COMMANDS
 async def start(update, context):
     tele_id = update.message.from_user.id
 
     # Verify if the user is registered
-    if is_user_registered(tele_id):
+    if await is_user_registered(tele_id):
         await update.message.reply_text("You are already registered.")
 
     try:
-        member = await context.bot.get_chat_member(ASSOC_CHAT_ID, tele_id)
-        if member.status in ['member', 'administrator', 'creator']:
+        if await is_associate(context.bot, tele_id):
             await update.message.reply_text("Hello! I am Haley, thanks for joining us!")
             keyboard = [
                 [InlineKeyboardButton("Register", callback_data='register')]
@@ -153,7 +841,7 @@ async def manager_home(update, context):
     chat_id = update.message.chat_id
 
     # Verify if the user is a manager
-    if not is_user_manager(user_id):
+    if not await is_user_manager(user_id):
         await update.message.reply_text("Er no...maybe ask Tim to add you?")
         return
 
@@ -182,7 +870,7 @@ async def head_trainer_options(update, context):
     chat_id = update.message.chat_id
 
     # Verify if the user is a manager
-    if not is_user_manager(user_id):
+    if not await is_user_manager(user_id):
         await update.message.reply_text("You're not a Head Trainer!")
         return
 
@@ -214,11 +902,17 @@ async def set_user_role(update, context):
     # Extract user ID and role from the admin user input
     try:
         user_id, role = context.args
+        user_id = int(user_id)
     except ValueError:
         await update.message.reply_text("Usage: /setrole <user_id> <role>")
         return
 
     # Update the user's role in the database
+    message_role = await run_db(update_user_role, user_id, role)
+    await update.message.reply_text(message_role)
+
+
+def update_user_role(user_id, role):
     connection = create_db_connection()
     cursor = None
     if connection is not None:
@@ -227,17 +921,35 @@ async def set_user_role(update, context):
             update_query = "UPDATE users SET account_type = %s WHERE telegram_id = %s"
             cursor.execute(update_query, (role, user_id))
             connection.commit()
-            await update.message.reply_text(f"Updated user {user_id} to {role}.")
+            if cursor.rowcount == 0:
+                # MySQL counts changed rows, so 0 is also what a user who already has the role gives
+                cursor.execute("SELECT 1 FROM users WHERE telegram_id = %s", (user_id,))
+                if not cursor.fetchone():
+                    return f"No registered user {user_id}, nothing was changed."
+                role_cache.set_role(user_id, role)
+                return f"User {user_id} is already {role}."
+            role_cache.set_role(user_id, role)
+            return f"Updated user {user_id} to {role}."
         except Error as e:
-            await update.message.reply_text("Error while updating the role in MySQL.")
             print("Error while updating MySQL", e)
+            return "Error while updating the role in MySQL."
         finally:
             if cursor is not None:
                 cursor.close()
-            if connection.is_connected():
-                connection.close()
+            connection.close()
     else:
-        await update.message.reply_text("Failed to connect to the database.")
+        return "Failed to connect to the database."
+
+
+async def db_stats(update, context):
+    # Check if the user who sent this command is the admin
+    if update.message.from_user.id != ADMIN_USER_ID:
+        await update.message.reply_text("You don't have permission to use this command.")
+        return
+
+    stats = db_pool.metrics()
+    message_stats = "DB pool:\n\n" + "".join(f"• {key}: {value}\n" for key, value in stats.items())
+    await update.message.reply_text(message_stats)
 
 
 async def view_personal_profile(update, context):
@@ -254,49 +966,60 @@ async def view_personal_profile(update, context):
     await query.edit_message_reply_markup(reply_markup=None)
 
     # Retrieve personal details
+    users = await run_db(fetch_user_profile, chat_id)
+    if users is None:
+        await context.bot.send_message(chat_id=chat_id, text="Failed to connect")
+        return
+
+    if not users:
+        await context.bot.send_message(chat_id=chat_id, text="No details found. Are you registered?")
+        return
+
+    profiles = "Your registered details:\n\n"
+    for user in users:
+        profiles += (f"• First Name: {user.first_name}\n• Last Name: {user.last_name}\n"
+                     f"• Date of Birth: {user.date_of_birth}\n• NRIC: {user.nric_number}\n"
+                     f"• MOE IRS Expiry: {user.moe_irs}\n• Mobile: {user.mobile}\n"
+                     f"• Postal Code: {user.postal}\n• Training Hours: {user.total_hours}\n\n")
+    await context.bot.send_message(chat_id=chat_id, text=profiles)
+
+    # Most recent credits first, a page at a time
+    history, nav = await show_page(hours_history_listing, (chat_id,))
+    await context.bot.send_message(chat_id=chat_id, text=history, reply_markup=page_markup(nav))
+    keyboard = [
+        [InlineKeyboardButton("Go to Main Page", callback_data='home')]
+    ]
+    reply_markup1 = InlineKeyboardMarkup(keyboard)
+    await context.bot.send_message(
+        chat_id=chat_id, text="If you need to edit any of these details, please approach the Halogen team.",
+        reply_markup=reply_markup1)
+
+
+def fetch_user_profile(telegram_id):
     connection = create_db_connection()
     cursor = None
     if connection is not None:
         try:
             cursor = connection.cursor()
+            # The total is kept up to date as hours are credited, see TRAINING HOURS LEDGER
             query = """
-                        SELECT first_name, last_name, date_of_birth, nric_number, 
-                               moe_irs, mobile, postal, training_hours 
-                        FROM users 
-                        WHERE telegram_id = %s
+                        SELECT u.first_name, u.last_name, u.date_of_birth, u.nric_number, 
+                               u.moe_irs, u.mobile, u.postal, COALESCE(t.total_hours, 0) AS total_hours
+                        FROM users u
+                        LEFT JOIN hours_totals t ON t.uid = u.uid
+                        WHERE u.telegram_id = %s
                     """
-            cursor.execute(query, (chat_id,))
-            users = cursor.fetchall()
-
-            if not users:
-                await context.bot.send_message(chat_id=chat_id, text="No details found. Are you registered?")
-                return
-
-            profiles = "Your registered details:\n\n"
-            for user in users:
-                profiles += (f"• First Name: {user[0]}\n• Last Name: {user[1]}\n"
-                             f"• Date of Birth: {user[2]}\n• NRIC: {user[3]}\n"
-                             f"• MOE IRS Expiry: {user[4]}\n• Mobile: {user[5]}\n"
-                             f"• Postal Code: {user[6]}\n• Training Hours: {user[7]}\n\n")
-            await context.bot.send_message(chat_id=chat_id, text=profiles)
-            keyboard = [
-                [InlineKeyboardButton("Go to Main Page", callback_data='home')]
-            ]
-            reply_markup1 = InlineKeyboardMarkup(keyboard)
-            await context.bot.send_message(
-                chat_id=chat_id, text="If you need to edit any of these details, please approach the Halogen team.",
-                reply_markup=reply_markup1)
-            return
-
+            cursor.execute(query, (telegram_id,))
+            return User.all(cursor)
         except Error as e:
-            return f"Error fetching user profiles: {e}"
+            print("Error fetching user profiles", e)
+            return None
         finally:
             if cursor is not None:
                 cursor.close()
-            if connection.is_connected():
-                connection.close()
+            connection.close()
     else:
-        await context.bot.send_message(chat_id=chat_id, text="Failed to connect")
+        return None
 
 
 async def about_bot(update, context):
@@ -317,6 +1040,248 @@ async def about_bot(update, context):
              " friends to join us in this impactful work! https://halogen.sg/halogenplus-volunteer/")
 
 
+# PERSISTENCE
+# Conversation states, user_data and registration drafts are kept in the bot_state table, so half-finished flows
+# survive a restart or deploy. Nothing is written while a message is being handled: changes are staged in memory, where
+# repeated changes to the same key collapse into one, and every PERSISTENCE_INTERVAL seconds they go out as one batched
+# upsert and one batched delete. Whatever is still staged at shutdown is written before the bot exits.
+PERSISTENCE_INTERVAL = float(os.getenv('PERSISTENCE_INTERVAL', '5'))
+
+
+class MySQLPersistence(BasePersistence):
+    def __init__(self, update_interval):
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True,
+                                                     callback_data=False),
+                         update_interval=update_interval)
+        self.pending = {}  # (kind, JSON key) -> value, or None to delete
+        self.conversations = {}  # conversation name -> keys of its live conversations
+        self.write_lock = asyncio.Lock()  # one batch in flight at a time, so flush() waits for the periodic write
+
+    def load(self, kind, max_age=None):
+        # Rows untouched for longer than max_age seconds are deleted rather than loaded
+        connection = create_db_connection()
+        if connection is None:
+            print("Failed to connect to the database")
+            return {}
+        cursor = None
+        try:
+            cursor = connection.cursor()
+            if max_age is not None:
+                cursor.execute("DELETE FROM bot_state WHERE kind = %s AND updated_at < NOW() - INTERVAL %s SECOND",
+                               (kind, int(max_age)))
+                if cursor.rowcount:
+                    logger.info(f"Dropped {cursor.rowcount} expired {kind} row(s)")
+                connection.commit()
+            cursor.execute("SELECT state_key, data FROM bot_state WHERE kind = %s", (kind,))
+            return {decode_state_key(state_key): json.loads(data) for state_key, data in cursor.fetchall()}
+        except Error as e:
+            print(f"Error loading {kind}: {e}")
+            return {}
+        finally:
+            if cursor is not None:
+                cursor.close()
+            connection.close()
+
+    async def load_kind(self, kind, max_age=None):
+        try:
+            return await run_db(self.load, kind, max_age)
+        except asyncio.TimeoutError:
+            logger.warning(f"Timed out loading {kind}, starting without it")
+            return {}
+
+    def stage(self, kind, key, value):
+        self.pending[(kind, json.dumps(key))] = value
+
+    def write(self, upserts, deletes):
+        try:
+            with UnitOfWork() as uow:
+                if upserts:
+                    # executemany sends this as a single multi-row INSERT
+                    uow.cursor.executemany("""
+                        INSERT INTO bot_state (kind, state_key, data) VALUES (%s, %s, %s)
+                        ON DUPLICATE KEY UPDATE data = VALUES(data)
+                    """, upserts)
+                if deletes:
+                    placeholders = ", ".join(["(%s, %s)"] * len(deletes))
+                    uow.cursor.execute(f"DELETE FROM bot_state WHERE (kind, state_key) IN ({placeholders})",
+                                       [value for pair in deletes for value in pair])
+            return True
+        except Error as e:
+            print(f"Error writing persisted state: {e}")
+            return False
+
+    async def write_behind(self):
+        async with self.write_lock:
+            if not self.pending:
+                return
+            if leader.lost.is_set():
+                # Another instance may be leading by now, and its state must not be overwritten with this one's
+                logger.warning(f"Not writing {len(self.pending)} persisted change(s) after losing leadership")
+                self.pending = {}
+                return
+            batch, self.pending = self.pending, {}
+            upserts = [(kind, key, json.dumps(value)) for (kind, key), value in batch.items() if value is not None]
+            deletes = [(kind, key) for (kind, key), value in batch.items() if value is None]
+            written = False
+            try:
+                written = await run_db(self.write, upserts, deletes)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                if not written:
+                    # Try again next time (or in the final flush if this was cancelled), unless the key has been
+                    # changed again since
+                    for item, value in batch.items():
+                        self.pending.setdefault(item, value)
+
+    async def get_user_data(self):
+        return await self.load_kind('user_data')
+
+    async def get_conversations(self, name):
+        # A restored conversation gets no timeout job, so one that was already idle past its timeout is dropped here
+        conversations = await self.load_kind(f'conversation:{name}', conversation_timeouts.get(name))
+        self.conversations[name] = set(conversations)
+        return conversations
+
+    async def update_user_data(self, user_id, data):
+        self.stage('user_data', user_id, data)
+
+    async def drop_user_data(self, user_id):
+        self.stage('user_data', user_id, None)
+
+    async def update_conversation(self, name, key, new_state):
+        # new_state is None when the conversation ends
+        self.stage(f'conversation:{name}', key, new_state)
+        live = self.conversations.setdefault(name, set())
+        if new_state is None:
+            live.discard(key)
+        else:
+            live.add(key)
+
+    async def flush(self):
+        await self.write_behind()
+
+    # chat_data, bot_data and callback_data aren't used by Haley, so they aren't stored
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+
+def decode_state_key(state_key):
+    # Conversation keys are tuples, which come back from JSON as lists
+    key = json.loads(state_key)
+    return tuple(key) if isinstance(key, list) else key
+
+
+persistence = MySQLPersistence(PERSISTENCE_INTERVAL)
+
+
+# REGISTRATION DRAFTS
+# Answers given during registration are kept here rather than in context.user_data. The photo stays on disk and only
+# its path is held, drafts untouched for DRAFT_TTL are swept, and at most DRAFT_MAX are kept (oldest dropped first), so
+# people abandoning /start can't grow memory or leave photos lying around. Drafts are persisted along with the
+# conversations, so a registration can carry on after a restart.
+DRAFT_TTL = float(os.getenv('DRAFT_TTL', '3600'))
+DRAFT_MAX = int(os.getenv('DRAFT_MAX', '1000'))
+DRAFT_SWEEP_INTERVAL = float(os.getenv('DRAFT_SWEEP_INTERVAL', '300'))
+# The photo counts as given once its file_id is known; the local copy (photo_path) can be fetched again from that
+REGISTRATION_FIELDS = ['first_name', 'last_name', 'date_of_birth', 'photo_file_id', 'nric_number', 'moe_irs', 'mobile',
+                       'postal']
+
+
+class DraftStore:
+    def __init__(self, ttl, max_drafts, persistence):
+        self.ttl = ttl
+        self.max_drafts = max_drafts
+        self.persistence = persistence
+        self.drafts = OrderedDict()  # user_id -> (draft, last_touched), least recently touched first
+
+    def load(self, drafts):
+        # Drafts restored on startup get a fresh TTL. Their photo may not have survived the restart; if so it is
+        # downloaded again from photo_file_id when the registration is confirmed.
+        for user_id, draft in drafts.items():
+            if draft.get('photo_path') and not os.path.exists(draft['photo_path']):
+                del draft['photo_path']
+            self.drafts[user_id] = (draft, time.monotonic())
+
+    def get(self, user_id):
+        entry = self.drafts.pop(user_id, None)
+        draft = entry[0] if entry else {}
+        self.drafts[user_id] = (draft, time.monotonic())
+        # The draft is usually changed right after, the change is picked up when it is written out
+        self.persistence.stage('registration_draft', user_id, draft)
+        while len(self.drafts) > self.max_drafts:
+            evicted_id, (evicted, _) = self.drafts.popitem(last=False)
+            self._remove_photo(evicted)
+            self.persistence.stage('registration_draft', evicted_id, None)
+        return draft
+
+    def set_photo(self, user_id, photo_path):
+        # A new photo replaces the last one, which is deleted
+        draft = self.get(user_id)
+        self._remove_photo(draft)
+        draft['photo_path'] = photo_path
+
+    def is_complete(self, draft):
+        return all(field in draft for field in REGISTRATION_FIELDS)
+
+    def discard(self, user_id):
+        entry = self.drafts.pop(user_id, None)
+        if entry:
+            self._remove_photo(entry[0])
+            self.persistence.stage('registration_draft', user_id, None)
+
+    def sweep(self):
+        cutoff = time.monotonic() - self.ttl
+        stale = [user_id for user_id, (_, touched) in self.drafts.items() if touched < cutoff]
+        for user_id in stale:
+            self.discard(user_id)
+        return len(stale)
+
+    def _remove_photo(self, draft):
+        photo_path = draft.pop('photo_path', None)
+        if photo_path and os.path.exists(photo_path):
+            os.remove(photo_path)
+
+    def __len__(self):
+        return len(self.drafts)
+
+
+registration_drafts = DraftStore(DRAFT_TTL, DRAFT_MAX, persistence)
+
+
+async def sweep_registration_drafts():
+    swept = registration_drafts.sweep()
+    if swept:
+        logger.info(f"Swept {swept} stale registration draft(s), {len(registration_drafts)} left")
+
+
 # CONVERSATION 1 - REGISTER FOR ACCOUNT - FIRST_NAME TO LOCKREG
 async def register(update, context):
     query = update.callback_query
@@ -332,7 +1297,7 @@ async def register(update, context):
     tele_id = update.callback_query.from_user.id
 
     # Verify if the user is registered
-    if is_user_registered(tele_id):
+    if await is_user_registered(tele_id):
         await query.edit_message_reply_markup(reply_markup=None)
         await context.bot.send_message(chat_id=query.message.chat_id, text="You are already registered.")
         return ConversationHandler.END
@@ -342,7 +1307,63 @@ async def register(update, context):
     return FIRST_NAME
 
 
-def is_user_registered(tele_id):
+# REGISTERED USERS
+# Telegram IDs of everyone registered, warmed with one query at startup. New rows are picked up by uid (auto
+# increment) above the last one seen, so users registered through another instance of the bot show up too.
+REGISTERED_REFRESH_INTERVAL = float(os.getenv('REGISTERED_REFRESH_INTERVAL', '60'))
+
+
+class RegisteredUsers:
+    def __init__(self):
+        self.telegram_ids = set()
+        self.watermark = 0  # Highest users.uid loaded so far
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        connection = create_db_connection()
+        if connection is None:
+            return
+        cursor = None
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT uid, telegram_id FROM users WHERE uid > %s ORDER BY uid", (self.watermark,))
+            rows = cursor.fetchall()
+        except Error as e:
+            print("Error while loading registered users", e)
+            return
+        finally:
+            if cursor is not None:
+                cursor.close()
+            connection.close()
+        with self.lock:
+            self.telegram_ids.update(row[1] for row in rows)
+            if rows:
+                self.watermark = max(self.watermark, rows[-1][0])
+            self.loaded = True
+
+    def add(self, telegram_id):
+        with self.lock:
+            self.telegram_ids.add(telegram_id)
+
+    def __contains__(self, telegram_id):
+        return telegram_id in self.telegram_ids
+
+
+registered_users = RegisteredUsers()
+
+
+async def is_user_registered(tele_id):
+    if tele_id in registered_users:
+        return True
+    # Misses are rare (new users) and might just be newer than our last refresh, so they are confirmed with the DB
+    registered = await run_db(fetch_is_registered, tele_id)
+    if registered:
+        registered_users.add(tele_id)
+    return registered
+
+
+def fetch_is_registered(tele_id):
     connection = create_db_connection()
     cursor = None
     if connection is not None:
@@ -356,14 +1377,14 @@ def is_user_registered(tele_id):
         finally:
             if cursor is not None:
                 cursor.close()
-            if connection.is_connected():
-                connection.close()
+            connection.close()
     else:
         return False
 
 
 async def first_name_handler(update, context):
-    context.user_data['first_name'] = update.message.text
+    draft = registration_drafts.get(update.effective_user.id)
+    draft['first_name'] = update.message.text
     keyboard = [
         [InlineKeyboardButton("Back", callback_data='register')],
         [InlineKeyboardButton("Cancel", callback_data='cancel_reg')],
@@ -374,7 +1395,8 @@ async def first_name_handler(update, context):
 
 
 async def last_name_handler(update, context):
-    context.user_data['last_name'] = update.message.text
+    draft = registration_drafts.get(update.effective_user.id)
+    draft['last_name'] = update.message.text
     keyboard = [
         [InlineKeyboardButton("Back", callback_data='backasklastname')],
         [InlineKeyboardButton("Cancel", callback_data='cancel_reg')],
@@ -385,12 +1407,13 @@ async def last_name_handler(update, context):
 
 
 async def date_of_birth_handler(update, context):
+    draft = registration_drafts.get(update.effective_user.id)
     dob_input = update.message.text
     # Parse date from DDMMYY format
     try:
         dob = datetime.strptime(dob_input, '%d%m%y')
         formatted_dob = dob.strftime('%Y-%m-%d')  # Convert to YYYY-MM-DD format
-        context.user_data['date_of_birth'] = formatted_dob
+        draft['date_of_birth'] = formatted_dob
         keyboard = [
             [InlineKeyboardButton("Back", callback_data='backaskdob')],
             [InlineKeyboardButton("Cancel", callback_data='cancel_reg')],
@@ -407,10 +1430,14 @@ async def date_of_birth_handler(update, context):
 
 
 async def photo_handler(update, context):
+    draft = registration_drafts.get(update.effective_user.id)
     photo = update.message.photo[-1]
     file = await context.bot.get_file(photo.file_id)
-    photo_binary = await file.download_as_bytearray()
-    context.user_data['photo'] = photo_binary
+    # The photo waits on disk next to the store until the registration is confirmed, only its path sits in the draft
+    temp_path = photo_store.temp_path()
+    await file.download_to_drive(temp_path)
+    registration_drafts.set_photo(update.effective_user.id, temp_path)
+    draft['photo_file_id'] = photo.file_id
     keyboard = [
         [InlineKeyboardButton("Back", callback_data='backaskphoto')],
         [InlineKeyboardButton("Cancel", callback_data='cancel_reg')],
@@ -422,6 +1449,7 @@ async def photo_handler(update, context):
 
 
 async def nric_number_handler(update, context):
+    draft = registration_drafts.get(update.effective_user.id)
     user_nric_number = update.message.text
 
     # Define the regex pattern for NRIC
@@ -429,7 +1457,7 @@ async def nric_number_handler(update, context):
 
     # Check if the entered NRIC matches the pattern
     if re.match(pattern1, user_nric_number):
-        context.user_data['nric_number'] = user_nric_number
+        draft['nric_number'] = user_nric_number
         keyboard = [
             [InlineKeyboardButton("Back", callback_data='backasknric')],
             [InlineKeyboardButton("Cancel", callback_data='cancel_reg')],
@@ -445,12 +1473,13 @@ async def nric_number_handler(update, context):
 
 
 async def moe_irs_handler(update, context):
+    draft = registration_drafts.get(update.effective_user.id)
     irs_input = update.message.text
     # Parse date from DDMMYY format
     try:
         irs = datetime.strptime(irs_input, '%d%m%y')
         formatted_irs = irs.strftime('%Y-%m-%d')  # Convert to YYYY-MM-DD format
-        context.user_data['moe_irs'] = formatted_irs
+        draft['moe_irs'] = formatted_irs
         keyboard = [
             [InlineKeyboardButton("Back", callback_data='backaskmoeirs')],
             [InlineKeyboardButton("Cancel", callback_data='cancel_reg')],
@@ -466,6 +1495,7 @@ async def moe_irs_handler(update, context):
 
 
 async def mobile_handler(update, context):
+    draft = registration_drafts.get(update.effective_user.id)
     user_phone_number = update.message.text
 
     # Define the regex pattern for mobile
@@ -473,7 +1503,7 @@ async def mobile_handler(update, context):
 
     # Check if the entered mobile matches the pattern
     if re.match(pattern2, user_phone_number):
-        context.user_data['mobile'] = user_phone_number
+        draft['mobile'] = user_phone_number
         keyboard = [
             [InlineKeyboardButton("Back", callback_data='backaskmobile')],
             [InlineKeyboardButton("Cancel", callback_data='cancel_reg')],
@@ -487,9 +1517,10 @@ async def mobile_handler(update, context):
 
 
 async def postal_handler(update, context):
-    context.user_data['postal'] = update.message.text
-    context.user_data['telegram_id'] = update.message.from_user.id
-    context.user_data['telegram_username'] = update.message.from_user.username  # Note: Username might be None
+    draft = registration_drafts.get(update.effective_user.id)
+    draft['postal'] = update.message.text
+    draft['telegram_id'] = update.message.from_user.id
+    draft['telegram_username'] = update.message.from_user.username  # Note: Username might be None
 
     user_postal_code = update.message.text
 
@@ -498,30 +1529,36 @@ async def postal_handler(update, context):
 
     # Check if the entered mobile matches the pattern
     if re.match(pattern3, user_postal_code):
-        context.user_data['postal'] = user_postal_code
+        draft['postal'] = user_postal_code
     else:
         await update.message.reply_text('Invalid format. Please enter a valid postal code.')
         return POSTAL
 
+    if not registration_drafts.is_complete(draft):
+        await update.message.reply_text("Sorry, this registration took too long and I lost your details! Please /start"
+                                        " again.")
+        registration_drafts.discard(update.effective_user.id)
+        return ConversationHandler.END
+
     # Converting dob readable formats
-    dob_date_str = context.user_data['date_of_birth']
+    dob_date_str = draft['date_of_birth']
     dob_date_a = datetime.strptime(dob_date_str, '%Y-%m-%d')
     formatted_dob_date = dob_date_a.strftime('%d %b %y')  # '04 Jan 23'
 
     # Converting MOE IRS readable formats
-    irs_date_str = context.user_data['moe_irs']
+    irs_date_str = draft['moe_irs']
     irs_date_a = datetime.strptime(irs_date_str, '%Y-%m-%d')
     formatted_irs_date = irs_date_a.strftime('%d %b %y')  # '04 Jan 23'
 
     # Assemble a summary of the collected data
     biodata_summary = (
-        f"First Name: {context.user_data['first_name']}\n"
-        f"Last Name: {context.user_data['last_name']}\n"
+        f"First Name: {draft['first_name']}\n"
+        f"Last Name: {draft['last_name']}\n"
         f"DOB: {formatted_dob_date}\n"
-        f"NRIC: {context.user_data['nric_number']}\n"
+        f"NRIC: {draft['nric_number']}\n"
         f"MOE IRS Expiry: {formatted_irs_date}\n"
-        f"Mobile Number: {context.user_data['mobile']}\n"
-        f"Postal Code: {context.user_data['postal']}\n"
+        f"Mobile Number: {draft['mobile']}\n"
+        f"Postal Code: {draft['postal']}\n"
     )
 
     keyboard = [
@@ -540,7 +1577,23 @@ async def handle_reg_confirm(update, context):
     query = update.callback_query
     await query.answer()
 
-    store_new_user(context.user_data)
+    draft = registration_drafts.get(update.effective_user.id)
+    if not registration_drafts.is_complete(draft):
+        await query.edit_message_reply_markup(reply_markup=None)
+        await context.bot.send_message(chat_id=query.message.chat_id, text="Sorry, this registration took too long and"
+                                                                           " I lost your details! Please /start again.")
+        registration_drafts.discard(update.effective_user.id)
+        return ConversationHandler.END
+    if 'photo_path' not in draft:
+        # The photo on disk was lost in a restart, get it again from Telegram
+        file = await context.bot.get_file(draft['photo_file_id'])
+        temp_path = photo_store.temp_path()
+        await file.download_to_drive(temp_path)
+        registration_drafts.set_photo(update.effective_user.id, temp_path)
+
+    # Only now does the photo go into the store
+    draft['photo_ref'] = await asyncio.to_thread(photo_store.put_file, draft.pop('photo_path'))
+    await run_db(store_new_user, draft)
 
     keyboard = [
         [InlineKeyboardButton("Take me there!", callback_data='home')]
@@ -550,8 +1603,8 @@ async def handle_reg_confirm(update, context):
     await context.bot.send_message(chat_id=query.message.chat_id, text="Registration complete! You can head to the main"
                                                                        " page now.", reply_markup=reply_markup1)
 
-    # Clear all existing data from context.user_data
-    context.user_data.clear()
+    # Clear the registration draft
+    registration_drafts.discard(update.effective_user.id)
 
     return ConversationHandler.END  # End the conversation or navigate to another state
 
@@ -568,8 +1621,8 @@ async def handle_reg_cancel(update, context):
     await context.bot.send_message(chat_id=query.message.chat_id, text="Sorry that you cancelled! Can we start over?",
                                    reply_markup=reply_markup1)
 
-    # Clear all existing data from context.user_data
-    context.user_data.clear()
+    # Clear the registration draft, and the photo waiting with it
+    registration_drafts.discard(update.effective_user.id)
 
     return ConversationHandler.END  # End the conversation
 
@@ -578,13 +1631,15 @@ async def back_asklastname(update, context):
     query = update.callback_query
     await query.answer()
 
+    draft = registration_drafts.get(update.effective_user.id)
+
     keyboard = [
         [InlineKeyboardButton("Back", callback_data='register')],
         [InlineKeyboardButton("Cancel", callback_data='cancel_reg')],
     ]
     reply_markup1 = InlineKeyboardMarkup(keyboard)
     await query.edit_message_reply_markup(reply_markup=None)
-    lastname = context.user_data.get('last_name', '')
+    lastname = draft.get('last_name', '')
     await context.bot.send_message(chat_id=query.message.chat_id,
                                    text=f"Please re-enter your last name. This is what you gave me just"
                                         f" now: {lastname}",
@@ -596,13 +1651,15 @@ async def back_askdob(update, context):
     query = update.callback_query
     await query.answer()
 
+    draft = registration_drafts.get(update.effective_user.id)
+
     keyboard = [
         [InlineKeyboardButton("Back", callback_data='backasklastname')],
         [InlineKeyboardButton("Cancel", callback_data='cancel_reg')],
     ]
     reply_markup1 = InlineKeyboardMarkup(keyboard)
     await query.edit_message_reply_markup(reply_markup=None)
-    dob = context.user_data.get('date_of_birth', '')
+    dob = draft.get('date_of_birth', '')
     await context.bot.send_message(chat_id=query.message.chat_id,
                                    text=f"Please re-enter your date of birth (DDMMYY). This is what you gave me just"
                                         f" now: {dob}",
@@ -630,13 +1687,15 @@ async def back_asknric(update, context):
     query = update.callback_query
     await query.answer()
 
+    draft = registration_drafts.get(update.effective_user.id)
+
     keyboard = [
         [InlineKeyboardButton("Back", callback_data='backaskphoto')],
         [InlineKeyboardButton("Cancel", callback_data='cancel_reg')],
     ]
     reply_markup1 = InlineKeyboardMarkup(keyboard)
     await query.edit_message_reply_markup(reply_markup=None)
-    nric = context.user_data.get('nric_number', '')
+    nric = draft.get('nric_number', '')
     await context.bot.send_message(chat_id=query.message.chat_id,
                                    text=f"Please re-enter your NRIC number. This is what you gave me just now: {nric}",
                                    reply_markup=reply_markup1)
@@ -647,13 +1706,15 @@ async def back_askmoeirs(update, context):
     query = update.callback_query
     await query.answer()
 
+    draft = registration_drafts.get(update.effective_user.id)
+
     keyboard = [
         [InlineKeyboardButton("Back", callback_data='backasknric')],
         [InlineKeyboardButton("Cancel", callback_data='cancel_reg')],
     ]
     reply_markup1 = InlineKeyboardMarkup(keyboard)
     await query.edit_message_reply_markup(reply_markup=None)
-    moeirs = context.user_data.get('moe_irs', '')
+    moeirs = draft.get('moe_irs', '')
     await context.bot.send_message(chat_id=query.message.chat_id,
                                    text=f"Please re-enter your MOE IRS expiry date (DDMMYY)."
                                         f" This is what you gave me just now: {moeirs}",
@@ -665,13 +1726,15 @@ async def back_askmobile(update, context):
     query = update.callback_query
     await query.answer()
 
+    draft = registration_drafts.get(update.effective_user.id)
+
     keyboard = [
         [InlineKeyboardButton("Back", callback_data='backaskmoeirs')],
         [InlineKeyboardButton("Cancel", callback_data='cancel_reg')],
     ]
     reply_markup1 = InlineKeyboardMarkup(keyboard)
     await query.edit_message_reply_markup(reply_markup=None)
-    mobile = context.user_data.get('mobile', '')
+    mobile = draft.get('mobile', '')
     await context.bot.send_message(chat_id=query.message.chat_id,
                                    text=f"Please re-enter your mobile number. This is what you gave me just"
                                         f" now: {mobile}",
@@ -683,13 +1746,15 @@ async def back_askpostal(update, context):
     query = update.callback_query
     await query.answer()
 
+    draft = registration_drafts.get(update.effective_user.id)
+
     keyboard = [
         [InlineKeyboardButton("Back", callback_data='backaskmobile')],
         [InlineKeyboardButton("Cancel", callback_data='cancel_reg')],
     ]
     reply_markup1 = InlineKeyboardMarkup(keyboard)
     await query.edit_message_reply_markup(reply_markup=None)
-    postal = context.user_data.get('postal', '')
+    postal = draft.get('postal', '')
     await context.bot.send_message(chat_id=query.message.chat_id,
                                    text=f"Please re-enter your postal code. This is what you gave me just"
                                         f" now: {postal}",
@@ -705,24 +1770,25 @@ def store_new_user(user_data):
         try:
             cursor = connection.cursor()
             insert_query = """
-                            INSERT INTO users (first_name, last_name, date_of_birth, photo, nric_number, moe_irs,
-                             mobile, postal, account_type, training_hours, telegram_id, telegram_handle)
-                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                            INSERT INTO users (first_name, last_name, date_of_birth, photo_ref, photo_file_id,
+                             nric_number, moe_irs, mobile, postal, account_type, training_hours, telegram_id,
+                             telegram_handle)
+                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
                             """
             user_values = (user_data['first_name'], user_data['last_name'], user_data['date_of_birth'],
-                           user_data['photo'], user_data['nric_number'], user_data['moe_irs'], user_data['mobile'],
-                           user_data['postal'], 'standard', '0.00', user_data['telegram_id'],
-                           user_data['telegram_username'])
+                           user_data['photo_ref'], user_data['photo_file_id'], user_data['nric_number'],
+                           user_data['moe_irs'], user_data['mobile'], user_data['postal'], 'standard', '0.00',
+                           user_data['telegram_id'], user_data['telegram_username'])
             cursor.execute(insert_query, user_values)
             connection.commit()
+            registered_users.add(user_data['telegram_id'])
 
         except Error as e:
             print("Error while inserting into MySQL", e)
         finally:
             if cursor is not None:
                 cursor.close()
-            if connection.is_connected():
-                connection.close()
+            connection.close()
     else:
         print("Failed to connect to the database")
 
@@ -750,30 +1816,87 @@ async def start_addprog(update, context):
     return SCHOOL
 
 
-def is_user_manager(user_id):
-    connection = create_db_connection()
-    if connection is not None:
-        try:
-            with connection.cursor(buffered=True) as cursor:
-                cursor.execute("SELECT account_type FROM users WHERE telegram_id = %s", (user_id,))
-                result = cursor.fetchone()
-                return result and result[0] == 'manager'
-        except Error as e:
-            print("Error while checking user role", e)
-            return False
-        finally:
-            if connection.is_connected():
-                connection.close()
-    else:
-        return False
+# ROLE CACHE
+# Manager checks happen on nearly every manager button press, so roles are answered from memory. The whole set is
+# reloaded every ROLE_CACHE_TTL seconds and /setrole writes through to it straight away.
+ROLE_CACHE_TTL = float(os.getenv('ROLE_CACHE_TTL', '300'))
 
 
-async def school(update, context: CallbackContext):
-    user_id = update.message.from_user.id
-    chat_id = update.message.chat_id
+class RoleCache:
+    def __init__(self):
+        self.managers = frozenset()
+        self.loaded = False
+        self.version = 0  # Bumped by every write, so a reload that raced with one doesn't clobber it
+        self.lock = threading.Lock()
 
-    context.user_data["telegram_id"] = user_id
-    context.user_data["chat_id"] = chat_id
+    def load(self):
+        with self.lock:
+            version = self.version
+        connection = create_db_connection()
+        if connection is None:
+            return
+        cursor = None
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT telegram_id FROM users WHERE account_type = 'manager'")
+            managers = frozenset(row[0] for row in cursor.fetchall())
+        except Error as e:
+            print("Error while loading user roles", e)
+            return
+        finally:
+            if cursor is not None:
+                cursor.close()
+            connection.close()
+        with self.lock:
+            if self.version == version:
+                self.managers = managers
+                self.loaded = True
+
+    def set_role(self, telegram_id, role):
+        with self.lock:
+            if role == 'manager':
+                self.managers = self.managers | {telegram_id}
+            else:
+                self.managers = self.managers - {telegram_id}
+            self.version += 1
+
+    def is_manager(self, telegram_id):
+        return telegram_id in self.managers
+
+
+role_cache = RoleCache()
+
+
+async def is_user_manager(user_id):
+    if role_cache.loaded:
+        return role_cache.is_manager(user_id)
+    # Startup load failed, ask the database until the next refresh works
+    return await run_db(fetch_is_manager, user_id)
+
+
+def fetch_is_manager(user_id):
+    connection = create_db_connection()
+    if connection is not None:
+        try:
+            with connection.cursor(buffered=True) as cursor:
+                cursor.execute("SELECT account_type FROM users WHERE telegram_id = %s", (user_id,))
+                result = cursor.fetchone()
+                return result and result[0] == 'manager'
+        except Error as e:
+            print("Error while checking user role", e)
+            return False
+        finally:
+            connection.close()
+    else:
+        return False
+
+
+async def school(update, context: CallbackContext):
+    user_id = update.message.from_user.id
+    chat_id = update.message.chat_id
+
+    context.user_data["telegram_id"] = user_id
+    context.user_data["chat_id"] = chat_id
     context.user_data['school'] = update.message.text
     await update.message.reply_text("Please enter the date of training (DDMMYY):")
     return PROG_DATE
@@ -826,19 +1949,16 @@ async def trainers_needed(update, context: CallbackContext):
 async def programme_name(update, context: CallbackContext):
     context.user_data['programme_name'] = update.message.text
 
-    # Converting date and time to readable formats
-    prog_date_str = context.user_data['prog_date']
-    start_time_str = context.user_data['start_time']
-    prog_date_a = datetime.strptime(prog_date_str, '%Y-%m-%d')
-    start_time_a = datetime.strptime(start_time_str, '%H:%M:%S')
-    formatted_date = prog_date_a.strftime('%d %b %y')  # '04 Jan 23'
-    formatted_time = start_time_a.strftime('%I:%M %p')  # '09:15 AM'
+    # The answers as the Job they will become, so they read the same as every other programme
+    start_time = datetime.strptime(context.user_data['start_time'], '%H:%M:%S')
+    programme = Job(prog_date=datetime.strptime(context.user_data['prog_date'], '%Y-%m-%d').date(),
+                    start_time=timedelta(hours=start_time.hour, minutes=start_time.minute))
 
     # Assemble a summary of the collected data
     data_summary = (
         f"School: {context.user_data['school']}\n"
-        f"Date: {formatted_date}\n"
-        f"Time: {formatted_time}\n"
+        f"Date: {programme.date_text}\n"
+        f"Time: {programme.time_text}\n"
         f"Hours: {context.user_data['hours']}\n"
         f"Level: {context.user_data['student_level']}\n"
         f"Trainers Needed: {context.user_data['trainers_needed']}\n"
@@ -859,7 +1979,7 @@ async def handle_prog_confirm(update, context):
     query = update.callback_query
     await query.answer()
 
-    store_programme_data(context.user_data)
+    await run_db(store_programme_data, context.user_data)
 
     await query.edit_message_reply_markup(reply_markup=None)
     keyboard = [
@@ -904,6 +2024,7 @@ def store_programme_data(data):
                                           data['prog_date'], data['start_time'], data['hours'], data['student_level'],
                                           data['trainers_needed'], 'incomplete', data['programme_name']))
             connection.commit()
+            listing_cache.bump()
 
             # Retrieve the auto-generated session_id
             session_id = cursor.lastrowid
@@ -914,8 +2035,7 @@ def store_programme_data(data):
         finally:
             if cursor is not None:
                 cursor.close()
-            if connection.is_connected():
-                connection.close()
+            connection.close()
 
 
 async def view_sesh_id(update, context):
@@ -924,32 +2044,220 @@ async def view_sesh_id(update, context):
 
     chat_id = update.callback_query.message.chat_id
 
+    job = await run_db(fetch_sesh_id, chat_id)
+    if job:
+        message_sesh_id = f"Programme ID: {job.session_id}"
+        await context.bot.send_message(chat_id=chat_id, text=message_sesh_id)
+
+
+def fetch_sesh_id(chat_id):
     connection = create_db_connection()
     cursor = None
     if connection is not None:
         try:
             cursor = connection.cursor()
+            # Chats are reused, so the one to show is the open programme, picked as lock_open_programme does
             query = """
             SELECT session_id FROM jobs 
-            WHERE chat_id = %s
+            WHERE chat_id = %s AND job_status = 'incomplete'
+            ORDER BY prog_date, session_id
+            LIMIT 1
             """
             cursor.execute(query, (chat_id,))
-            job = cursor.fetchone()
-
-            if not job:
-                return "No programme found. You sure it got added?"
-            message_sesh_id = f"Programme ID: {job}"
-            await context.bot.send_message(chat_id=chat_id, text=message_sesh_id)
-            return
+            return Job.one(cursor)
         except Error as e:
-            return "Error while inserting into MySQL", e
+            print("Error while fetching programme ID", e)
+            return None
         finally:
             if cursor is not None:
                 cursor.close()
-            if connection.is_connected():
-                connection.close()
+            connection.close()
     else:
-        return "Failed to connect to the database."
+        return None
+
+
+# PROGRAMME LISTING CACHE
+# Rendered programme list pages, keyed by the date range and page asked for. Anything that changes which programmes are
+# open or how many slots they have bumps the version, which invalidates every cached list at once. The TTL bounds how
+# stale a list can get when another instance of the bot made the change.
+LISTING_CACHE_TTL = float(os.getenv('LISTING_CACHE_TTL', '120'))
+
+
+class ListingCache:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.version = 0
+        self.entries = {}  # (listing, params, cursor, backwards) -> (version, expires_at, page)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry and entry[0] == self.version and entry[1] > time.monotonic():
+            return entry[2]
+        return None
+
+    def put(self, key, version, page):
+        # version is the one read before querying, so a list rendered across a bump is never served
+        with self.lock:
+            if version != self.version:
+                return
+            now = time.monotonic()
+            self.entries = {k: v for k, v in self.entries.items() if v[0] == version and v[1] > now}
+            self.entries[key] = (version, now + self.ttl, page)
+
+    def bump(self):
+        with self.lock:
+            self.version += 1
+            self.entries = {}
+
+
+listing_cache = ListingCache(LISTING_CACHE_TTL)
+
+
+# PAGINATION
+# Long listings are shown a page at a time. Each page is fetched with a keyset query (WHERE key > last key shown
+# ORDER BY key LIMIT n) so only one page is ever read from the database, however far along it is. Prev/Next edit the
+# same message in place, and everything needed to fetch the next page is in the button's callback data:
+#   page:<listing>:<n|p>:<cursor>:<arg>
+PAGE_SIZE = int(os.getenv('PAGE_SIZE', '10'))
+listings = {}
+
+
+class Listing:
+    # select is a query ending in a WHERE clause taking params, its rows decoded as model; key_columns must be unique
+    # together and give the order, newest first if descending. scope(query, arg) rebuilds params when a page button is
+    # pressed; anything not safe to take from the button (eg. whose chat or applications these are) is read from the
+    # update instead of arg.
+    def __init__(self, name, select, model, key_columns, key, header, format_row, empty, error, scope, cache=None,
+                 descending=False):
+        self.name = name
+        self.select = select
+        self.model = model
+        self.key_columns = key_columns
+        self.key = key
+        self.header = header
+        self.format_row = format_row
+        self.empty = empty
+        self.error = error
+        self.scope = scope
+        self.cache = cache
+        self.descending = descending
+        listings[name] = self
+
+    def fetch(self, params, cursor=None, backwards=False):
+        query = self.select
+        args = list(params)
+        # Going back through a descending listing walks the keys upwards, and the other way round
+        descending = self.descending != backwards
+        if cursor:
+            condition, condition_args = keyset_condition(self.key_columns, cursor.split(','),
+                                                         '<' if descending else '>')
+            query += f" AND {condition}"
+            args += condition_args
+        order = 'DESC' if descending else 'ASC'
+        query += " ORDER BY " + ", ".join(f"{column} {order}" for column in self.key_columns) + " LIMIT %s"
+        args.append(PAGE_SIZE + 1)  # one extra row says whether there is another page
+
+        connection = create_db_connection()
+        if connection is None:
+            return None
+        cursor_db = None
+        try:
+            cursor_db = connection.cursor()
+            cursor_db.execute(query, args)
+            return self.model.all(cursor_db)
+        except Error as e:
+            print(f"Error fetching {self.name} page: {e}")
+            return None
+        finally:
+            if cursor_db is not None:
+                cursor_db.close()
+            connection.close()
+
+    def page(self, params, arg='', cursor=None, backwards=False):
+        # Returns (text, nav_buttons)
+        version = self.cache.version if self.cache else None
+        rows = self.fetch(params, cursor, backwards)
+        if rows is None:
+            return self.error, []
+        if not rows and cursor:
+            # Everything on that side has gone since the page was shown, start again from the top
+            return self.page(params, arg)
+        if not rows:
+            text, nav = self.empty, []
+        else:
+            more = len(rows) > PAGE_SIZE
+            rows = rows[:PAGE_SIZE]
+            if backwards:
+                rows.reverse()
+                has_prev, has_next = more, True
+            else:
+                has_prev, has_next = cursor is not None, more
+
+            text = self.header(params) + "".join(self.format_row(row) for row in rows)
+            nav = []
+            if has_prev:
+                nav.append(InlineKeyboardButton("« Prev", callback_data=self.callback_data('p', rows[0], arg)))
+            if has_next:
+                nav.append(InlineKeyboardButton("Next »", callback_data=self.callback_data('n', rows[-1], arg)))
+
+        if self.cache:
+            self.cache.put((self.name, tuple(params), cursor, backwards), version, (text, nav))
+        return text, nav
+
+    def callback_data(self, direction, row, arg):
+        cursor = ",".join(str(value) for value in self.key(row))
+        return f"page:{self.name}:{direction}:{cursor}:{arg}"
+
+
+def keyset_condition(columns, values, op):
+    # (a, b) > (x, y) as (a > x OR (a = x AND b > y)), which MySQL can answer with an index range scan
+    clauses = []
+    args = []
+    for i, column in enumerate(columns):
+        clauses.append(" AND ".join([f"{c} = %s" for c in columns[:i]] + [f"{column} {op} %s"]))
+        args += values[:i + 1]
+    return "(" + " OR ".join(f"({clause})" for clause in clauses) + ")", args
+
+
+async def show_page(listing, params, arg='', cursor=None, backwards=False):
+    if listing.cache:
+        page = listing.cache.get((listing.name, tuple(params), cursor, backwards))
+        if page is not None:
+            return page
+    return await run_db(listing.page, params, arg, cursor, backwards)
+
+
+def page_markup(nav, rows=()):
+    keyboard = ([nav] if nav else []) + list(rows)
+    return InlineKeyboardMarkup(keyboard) if keyboard else None
+
+
+def is_nav_row(row):
+    return any(button.callback_data and str(button.callback_data).startswith('page:') for button in row)
+
+
+async def turn_page(update, context):
+    query = update.callback_query
+    _, name, direction, cursor, arg = query.data.split(':', 4)
+    listing = listings.get(name)
+    if listing is None:
+        await query.answer()
+        return
+
+    text, nav = await show_page(listing, listing.scope(query, arg), arg, cursor or None, direction == 'p')
+    await query.answer()
+
+    # Keep any other buttons that were sent with the listing
+    rows = []
+    if query.message.reply_markup:
+        rows = [row for row in query.message.reply_markup.inline_keyboard if not is_nav_row(row)]
+    try:
+        await query.edit_message_text(text, reply_markup=page_markup(nav, rows))
+    except BadRequest as e:
+        # Double taps land on the page already shown
+        if 'not modified' not in str(e).lower():
+            raise
 
 
 # CONVERSATION 3 - LIST ALL JOBS - SELECT_DATE TO LIST_END
@@ -980,15 +2288,15 @@ async def select_date(update, context):
         mysql_start_date = start_date.strftime("%Y-%m-%d")
         mysql_end_date = end_date.strftime("%Y-%m-%d")
 
-        # Fetch jobs from the database
-        message_select_date = fetch_jobs(mysql_start_date, mysql_end_date)
+        # First page of jobs, from the cache or the database
+        message_select_date, nav = await show_page(job_listing, (mysql_start_date, mysql_end_date),
+                                                   f"{mysql_start_date},{mysql_end_date}")
         keyboard = [
             [InlineKeyboardButton("Go to main page", callback_data='home')],
             [InlineKeyboardButton("Sign up for a programme", callback_data='signup')],
             [InlineKeyboardButton("Get a different list", callback_data='list')],
         ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text(message_select_date, reply_markup=reply_markup)
+        await update.message.reply_text(message_select_date, reply_markup=page_markup(nav, keyboard))
         return ConversationHandler.END
     else:
         await update.message.reply_text("Invalid month format. Please enter the month in 3 letters or spell it out.")
@@ -1049,46 +2357,98 @@ def process_month_input(input_month):
     return start_date, end_date
 
 
-def fetch_jobs(start_date, end_date):
+def format_job_row(job):
+    return (f"ID Number: {job.session_id}\n\t• Programme: {job.programme_name}\n\t• School: {job.school}"
+            f"\n\t• Date: {job.date_text}\n\t• Time: {job.time_text}\n\t• Hours: {job.hours}\n\n")
+
+
+def job_listing_header(params):
+    formatted_start_date = datetime.strptime(params[0], '%Y-%m-%d').strftime('%d %b %y')
+    formatted_end_date = datetime.strptime(params[1], '%Y-%m-%d').strftime('%d %b %y')
+    return f"Programmes from {formatted_start_date} to {formatted_end_date}:\n\n"
+
+
+job_listing = Listing(
+    'jobs',
+    select="""
+    SELECT session_id, programme_name, school, prog_date, start_time, hours FROM jobs 
+    WHERE prog_date BETWEEN %s AND %s AND trainers_needed > 0 AND job_status = 'incomplete'
+    """,
+    model=Job,
+    key_columns=('prog_date', 'session_id'),
+    key=lambda job: (job.prog_date, job.session_id),
+    header=job_listing_header,
+    format_row=format_job_row,
+    empty="No programmes found in the specified period.",
+    error="Error retrieving programmes.",
+    scope=lambda query, arg: tuple(arg.split(',')),
+    cache=listing_cache,
+)
+
+
+# PROGRAMME LOOKUP
+# The signup flow needs the same programme at every step (to check it, show it, then sign up for it), so open
+# programmes are fetched once into an LRU cache keyed by session_id and every step reuses that row. An entry is dropped
+# when its programme is completed, and otherwise lasts PROGRAMME_CACHE_TTL seconds in case it is edited directly.
+PROGRAMME_CACHE_SIZE = int(os.getenv('PROGRAMME_CACHE_SIZE', '500'))
+PROGRAMME_CACHE_TTL = float(os.getenv('PROGRAMME_CACHE_TTL', '300'))
+PROGRAMME_COLUMNS = ['session_id', 'chat_id', 'programme_name', 'school', 'prog_date', 'start_time', 'hours',
+                     'student_level']
+
+
+class ProgrammeCache:
+    def __init__(self, max_size, ttl):
+        self.ttl = ttl
+        self.entries = LRUCache(max_size)  # session_id -> (Job, expires_at)
+        self.lock = threading.Lock()  # invalidate is called from the DB threads
+
+    async def get(self, session_id):
+        # The open programme with this ID as a Job, or None if there isn't one
+        with self.lock:
+            entry = self.entries.get(session_id)
+        if entry and entry[1] > time.monotonic():
+            return entry[0]
+        programme = await run_db(fetch_programme, session_id)
+        if programme is not None:
+            with self.lock:
+                self.entries.put(session_id, (programme, time.monotonic() + self.ttl))
+        return programme
+
+    def invalidate(self, session_id):
+        with self.lock:
+            self.entries.pop(session_id)
+
+
+programme_cache = ProgrammeCache(PROGRAMME_CACHE_SIZE, PROGRAMME_CACHE_TTL)
+
+
+def fetch_programme(session_id):
     connection = create_db_connection()
     cursor = None
     if connection is not None:
         try:
             cursor = connection.cursor()
-            query = """
-            SELECT session_id, programme_name, school, prog_date, start_time, hours FROM jobs 
-            WHERE prog_date BETWEEN %s AND %s AND trainers_needed > 0 AND job_status = 'incomplete'
+            query = f"""
+            SELECT {', '.join(PROGRAMME_COLUMNS)} 
+            FROM jobs 
+            WHERE session_id = %s AND job_status = 'incomplete'
             """
-            cursor.execute(query, (start_date, end_date))
-            jobs = cursor.fetchall()
-
-            if not jobs:
-                return "No programmes found in the specified period."
-
-            start_date_obj = datetime.strptime(start_date, '%Y-%m-%d')
-            end_date_obj = datetime.strptime(end_date, '%Y-%m-%d')
-            formatted_start_date = start_date_obj.strftime('%d %b %y')
-            formatted_end_date = end_date_obj.strftime('%d %b %y')
-            message_fetch_jobs = f"Programmes from {formatted_start_date} to {formatted_end_date}:\n\n"
-            for job in jobs:
-                # Check if job[4] is a timedelta object and format it
-                formatted_time_b = (datetime.min + job[4]).strftime('%I:%M %p') \
-                    if isinstance(job[4], timedelta) \
-                    else str(job[4])
-                message_fetch_jobs += (f"ID Number: {job[0]}\n\t• Programme: {job[1]}\n\t• School: {job[2]}\n\t• Date:"
-                                       f" {job[3].strftime('%d %b %y')}\n\t• Time: {formatted_time_b}\n\t• Hours:"
-                                       f" {job[5]}\n\n")
-            return message_fetch_jobs
-
+            cursor.execute(query, (session_id,))
+            return Job.one(cursor)
         except Error as e:
-            return "Error retrieving programmes.", e
+            print("Error while checking programme status", e)
+            return None
         finally:
             if cursor is not None:
                 cursor.close()
-            if connection.is_connected():
-                connection.close()
+            connection.close()
     else:
-        return "Failed to connect to the database."
+        return None
+
+
+def programme_details(programme):
+    return (f"Programme: {programme.programme_name}\nSchool: {programme.school}\nDate: {programme.date_text}\nTime:"
+            f" {programme.time_text}\nHours: {programme.hours}\n")
 
 
 # CONVERSATION 4 - APPLYING FOR JOB - APPLY_JOB TO ANOTHER_JOB
@@ -1112,82 +2472,22 @@ async def apply_job_handler(update, context):
 async def apply_job(update, context):
     session_id = update.message.text
 
-    # Check if the job exists and if the user has already applied
-    if not job_exists(session_id):
+    # Check if the job exists, fetching it for the rest of the signup
+    programme = await programme_cache.get(int(session_id)) if session_id.isdigit() else None
+    if programme is None:
         await update.message.reply_text("This ID is either invalid or belongs to an old programme."
                                         " Please enter a valid programme ID number.")
         return APPLY_JOB
 
     # Show job details for user to confirm
-    message_job_check = fetch_one_job(session_id)
     await update.message.reply_text("Please confirm that this is the programme you are signing up for")
-    await update.message.reply_text(message_job_check)
+    await update.message.reply_text(programme_details(programme))
     await update.message.reply_text("If this is correct, please enter the ID Number again. If not, /cancel and start"
                                     " over.")
     context.user_data['app_session_id'] = session_id
     return CONFIRM_APPLY
 
 
-def job_exists(session_id):
-    connection = create_db_connection()
-    cursor = None
-    if connection is not None:
-        try:
-            cursor = connection.cursor()
-            query = """
-            SELECT COUNT(*) 
-            FROM jobs 
-            WHERE session_id = %s AND job_status = 'incomplete'
-            """
-            cursor.execute(query, (session_id,))
-            (count,) = cursor.fetchone()
-            return count > 0
-        except Error as e:
-            print("Error while checking programme status", e)
-        finally:
-            if cursor is not None:
-                cursor.close()
-            if connection.is_connected():
-                connection.close()
-    else:
-        return False
-
-
-def fetch_one_job(session_id):
-    connection = create_db_connection()
-    cursor = None
-    if connection is not None:
-        try:
-            cursor = connection.cursor()
-            query = """
-            SELECT programme_name, school, prog_date, start_time, hours 
-            FROM jobs 
-            WHERE session_id = %s AND job_status = 'incomplete'
-            """
-            cursor.execute(query, (session_id,))
-            job = cursor.fetchone()
-
-            if not job:
-                return "No programme found with the provided Session ID."
-            programme, school, prog_date, start_time, hours = job
-            # Check if job[4] is a timedelta object and format it
-            formatted_time_c = (datetime.min + start_time).strftime('%I:%M %p') \
-                if isinstance(start_time, timedelta) \
-                else str(start_time)
-            message_fetch_job = (f"Programme: {programme}\nSchool: {school}\nDate:"
-                                 f" {prog_date.strftime('%d %b %y')}\nTime: {formatted_time_c}\nHours: {hours}\n")
-            return message_fetch_job
-        except Error as e:
-            return "Error retrieving programme details.", e
-        finally:
-            if cursor is not None:
-                cursor.close()
-            if connection.is_connected():
-                connection.close()
-    else:
-        return "Failed to connect to the database."
-
-
 async def confirm_apply(update, context):
     telegram_id = update.message.from_user.id
     session_id = update.message.text
@@ -1196,16 +2496,29 @@ async def confirm_apply(update, context):
         await update.message.reply_text("You keyed in the wrong ID number. Please enter the ID number again.")
         return CONFIRM_APPLY
 
-    # Check if the application exists (the user has already applied)
-    if app_exists(telegram_id, session_id):
+    # The same programme row as the last step, unless it has been closed since
+    programme = await programme_cache.get(int(session_id))
+    if programme is None:
+        await update.message.reply_text("Sorry, this programme is no longer open for sign ups.")
+        context.user_data.clear()
+        return ConversationHandler.END
+
+    # Enter the application into the database, which also tells us if the user has already applied
+    outcome = await run_db(insert_app, telegram_id, programme)
+    if outcome is None:
+        await update.message.reply_text("Sorry, I couldn't save your sign up. Please try again.")
+        context.user_data.clear()
+        return ConversationHandler.END
+    if outcome == 'unregistered':
+        await update.message.reply_text("I can't find your details. Please register with /start before signing up.")
+        context.user_data.clear()
+        return ConversationHandler.END
+    if outcome == 'repeat':
         await update.message.reply_text("You have already signed up for this programme.")
         # Clear all existing data from context.user_data
         context.user_data.clear()
         return ConversationHandler.END
 
-    # Enter the application into the database
-    insert_app(telegram_id, session_id)
-
     # Ask if they want to sign up for another
     keyboard = [
         [InlineKeyboardButton("Yes", callback_data='confirm_another')],
@@ -1217,76 +2530,60 @@ async def confirm_apply(update, context):
     return ANOTHER_JOB
 
 
-def app_exists(telegram_id, session_id):
-    connection = create_db_connection()
-    cursor = None
-    if connection is not None:
-        try:
-            cursor = connection.cursor()
-            query = """
-                    SELECT COUNT(*) 
-                    FROM applications 
-                    WHERE telegram_id = %s 
-                    AND session = %s 
-                    AND app_status IN ('accepted', 'pending', 'rejected')
-                    """
-            cursor.execute(query, (telegram_id, session_id,))
-            (count,) = cursor.fetchone()
-            return count > 0
-        except Error as e:
-            print("Error while checking application status", e)
-        finally:
-            if cursor is not None:
-                cursor.close()
-            if connection.is_connected():
-                connection.close()
-    else:
-        return False
-
-
-def insert_app(telegram_id, session_id):
+def insert_app(telegram_id, programme):
+    # Returns 'new' for a new sign up, 'repeat' if the user had already signed up, 'unregistered' if they have no users
+    # row, None on error. UNIQUE (telegram_id, session_id) turns a repeat (eg. a double tap) into an update that changes
+    # nothing and reports 0 rows; only a withdrawn application is reopened, which reports 2. No users row also inserts
+    # nothing, so 0 rows is told apart from that with one more lookup.
     connection = create_db_connection()
     cursor = None
     if connection is not None:
         try:
             cursor = connection.cursor()
-            cursor.execute("SET time_zone = '+08:00';")
             insert_query = """
                 INSERT INTO applications (uid, telegram_id, session_id, chat_id, first_name, last_name, mobile, postal,
                  programme_name, school, prog_date, start_time, hours, student_level, app_status, apply_time)
                 SELECT 
                     u.uid, 
                     u.telegram_id, 
-                    j.session_id, 
-                    j.chat_id, 
+                    %s, 
+                    %s, 
                     u.first_name, 
                     u.last_name, 
                     u.mobile, 
                     u.postal, 
-                    j.programme_name, 
-                    j.school, 
-                    j.prog_date, 
-                    j.start_time, 
-                    j.hours, 
-                    j.student_level, 
+                    %s, 
+                    %s, 
+                    %s, 
+                    %s, 
+                    %s, 
+                    %s, 
                     'pending', 
                     NOW()
                 FROM 
                     users u
-                JOIN 
-                    jobs j ON j.session_id = %s
                 WHERE 
-                    u.telegram_id = %s;
+                    u.telegram_id = %s
+                ON DUPLICATE KEY UPDATE
+                    apply_time = IF(applications.app_status = 'withdrawn', NOW(), applications.apply_time),
+                    app_status = IF(applications.app_status = 'withdrawn', 'pending', applications.app_status)
                 """
-            cursor.execute(insert_query, (session_id, telegram_id))
+            # The programme's columns come from the row the signup flow already fetched
+            cursor.execute(insert_query, (*(getattr(programme, column) for column in PROGRAMME_COLUMNS), telegram_id))
             connection.commit()
+            if cursor.rowcount > 0:
+                return 'new'
+            cursor.execute("SELECT 1 FROM users WHERE telegram_id = %s", (telegram_id,))
+            return 'repeat' if cursor.fetchone() else 'unregistered'
         except Error as e:
             print("Error while saving signup. Please check in with Halogen!", e)
+            return None
         finally:
             if cursor is not None:
                 cursor.close()
-            if connection.is_connected():
-                connection.close()
+            connection.close()
+    else:
+        return None
 
 
 async def handle_another_confirm(update, context):
@@ -1330,10 +2627,10 @@ async def view_applications(update, context):
         return
 
     # Query the database
-    message_viewapp = fetch_apps(chat_id)
+    message_viewapp, nav = await show_page(application_listing, (chat_id,))
     await query.edit_message_reply_markup(reply_markup=None)
     await context.bot.send_message(chat_id=query.message.chat_id,
-                                   text=message_viewapp)
+                                   text=message_viewapp, reply_markup=page_markup(nav))
 
     keyboard = [
         [InlineKeyboardButton("Accept applicants", callback_data='accept_app')],
@@ -1346,37 +2643,29 @@ async def view_applications(update, context):
     return ACCEPT_OR_REJECT
 
 
-def fetch_apps(chat_id):
-    connection = create_db_connection()
-    cursor = None
-    if connection is not None:
-        try:
-            cursor = connection.cursor()
-            query = """
-                    SELECT uid, first_name, last_name, postal 
-                    FROM applications 
-                    WHERE chat_id = %s AND app_status = 'pending'
-                    """
-            cursor.execute(query, (chat_id,))
-            applications = cursor.fetchall()
-
-            if not applications:
-                return "No applications yet."
+# The chat's open programme, picked as lock_open_programme does, for queries that list what is done in a chat
+OPEN_PROGRAMME_IN_CHAT = ("(SELECT session_id FROM jobs WHERE chat_id = %s AND job_status = 'incomplete'"
+                          " ORDER BY prog_date, session_id LIMIT 1)")
 
-            applications_info = f"Applications:\n\n"
-            for app in applications:
-                applications_info += f"UID: {app[0]}\n\t• Name: {app[1]} {app[2]}\n\t• Postal: {app[3]}\n\n"
-            return applications_info
 
-        except Error as e:
-            return "Error retrieving application details.", e
-        finally:
-            if cursor is not None:
-                cursor.close()
-            if connection.is_connected():
-                connection.close()
-    else:
-        return "Failed to connect to the database."
+application_listing = Listing(
+    'apps',
+    # Pending applications to the chat's open programme, the one accept and reject act on, so each uid appears once
+    select=f"""
+            SELECT uid, first_name, last_name, postal 
+            FROM applications 
+            WHERE session_id = {OPEN_PROGRAMME_IN_CHAT} AND app_status = 'pending'
+            """,
+    model=JobApplication,
+    key_columns=('uid',),
+    key=lambda app: (app.uid,),
+    header=lambda params: "Applications:\n\n",
+    format_row=lambda app: (f"UID: {app.uid}\n\t• Name: {app.first_name} {app.last_name}"
+                            f"\n\t• Postal: {app.postal}\n\n"),
+    empty="No applications yet.",
+    error="Error retrieving application details.",
+    scope=lambda query, arg: (query.message.chat_id,),
+)
 
 
 #  COMMAND - ACCEPT APPLICATIONS
@@ -1393,7 +2682,7 @@ async def app_accept_button(update, context):
         return
 
     # Verify if the user is a manager
-    if not is_user_manager(user_id):
+    if not await is_user_manager(user_id):
         await context.bot.send_message(chat_id=query.message.chat_id, text="You must be a manager to use this command.")
         return
 
@@ -1429,96 +2718,149 @@ async def accept_applicants(update, context):
         await update.message.reply_text(str(e))
         return
 
-    # Determine number of UIDs accepted
-    num_accepted = len(uids)
-    update_trainers_subtract(chat_id, num_accepted)
-
-    # Update the database and send notifications
-    for uid in uids:
-        await update_accept_application(bot, chat_id, uid)
+    # Update the database in one transaction, then send notifications
+    outcome = await run_db(accept_applications, chat_id, uids)
+    if outcome is None:
+        await context.bot.send_message(chat_id=chat_id, text="Sorry something went wrong, nobody was accepted. Please"
+                                                             " try again.")
+        return ConversationHandler.END
+    results, no_slot, not_pending = outcome
 
-    await context.bot.send_message(chat_id=chat_id, text="Applicant(s) have been accepted.")
+    # One invite link for the whole batch
+    join_link = None
+    if results:
+        try:
+            join_link = await invite_links.get(context.bot, chat_id)
+        except Exception as e:
+            logging.error(f"Error exporting chat invite link: {e}")
+            join_link = "Unavailable"
+
+    # Notifications go out in the background, the manager gets a delivery report when they are done
+    notifier.send_batch([accepted_message(result, join_link) for result in results],
+                        on_complete=delivery_reporter(context.bot, chat_id, "Acceptances"))
+
+    message_accept = f"{len(results)} applicant(s) have been accepted."
+    if no_slot:
+        message_accept += (f" There were no slots left for UID(s) {', '.join(map(str, no_slot))}, they are still"
+                           f" pending.")
+    if not_pending:
+        message_accept += f" UID(s) {', '.join(map(str, not_pending))} had no pending application."
+    await context.bot.send_message(chat_id=chat_id, text=message_accept)
     # Clear all existing data from context.user_data
     context.user_data.clear()
     return ConversationHandler.END
 
 
-def update_trainers_subtract(chat_id, num_accepted):
-    connection = create_db_connection()
-    cursor = None
-    if connection is not None:
-        try:
-            cursor = connection.cursor()
-            query = """
-                    UPDATE jobs
-                    SET trainers_needed = trainers_needed - %s
-                    WHERE chat_id = %s
-                    """
-            cursor.execute(query, (num_accepted, chat_id))
-            connection.commit()
-        except mysql.connector.Error as e:
-            print(f"Error updating trainers_needed: {e}")
-        finally:
-            if cursor is not None:
-                cursor.close()
-            if connection.is_connected():
-                connection.close()
-
+def accept_applications(chat_id, uids):
+    # Returns (accepted rows, UIDs left pending for lack of slots, UIDs with no pending application), or None on error.
+    # Constant number of queries no matter how many UIDs, and the transaction holds its locks only for those queries.
+    uids = list(dict.fromkeys(uids))
+    try:
+        with UnitOfWork() as uow:
+            session_id = lock_open_programme(uow.cursor, chat_id)
+            if session_id is None:
+                logging.warning(f"No open programme in chat {chat_id}")
+                return [], [], uids
+            pending = lock_pending_applications(uow.cursor, session_id, uids)
+            granted = reserve_slots(uow.cursor, session_id, len(pending))
+            accepted, no_slot = pending[:granted], pending[granted:]
+            results = []
+            if accepted:
+                results = update_application_statuses(uow.cursor, session_id, accepted, 'accepted',
+                                                      "programme_name, school, prog_date, start_time, hours,"
+                                                      " telegram_id, uid")
+                uow.on_commit(listing_cache.bump)
+            not_pending = [uid for uid in uids if uid not in pending]
+            if not_pending:
+                logging.warning(f"No pending application found for {len(not_pending)} UID(s)")
+            return results, no_slot, not_pending
+    except mysql.connector.Error as e:
+        print(f"Error updating application statuses: {e}")
+        return None
 
-async def update_accept_application(bot, chat_id, uid):
-    connection = create_db_connection()
-    cursor = None
-    if connection is not None:
-        try:
-            # Update application status
-            cursor = connection.cursor()
-            query = """
-                    UPDATE applications
-                    SET app_status = 'accepted'
-                    WHERE chat_id = %s 
-                    AND uid = %s 
-                    AND app_status = 'pending'
-                    """
-            cursor.execute(query, (chat_id, uid))
-            connection.commit()
 
-            # Retrieve application data
-            select_query = """
-                                           SELECT programme_name, school, prog_date, start_time, hours, telegram_id
-                                           FROM applications
-                                           WHERE chat_id = %s AND uid = %s
-                                           """
-            cursor.execute(select_query, (chat_id, uid))
-            result = cursor.fetchone()
+def lock_open_programme(cursor, chat_id):
+    # The session_id of the chat's open programme, locked until the transaction ends. Group chats are reused for later
+    # programmes, so everything done in a chat is scoped to this one job; if several are open the earliest comes first.
+    query = """
+            SELECT session_id FROM jobs
+            WHERE chat_id = %s AND job_status = 'incomplete'
+            ORDER BY prog_date, session_id
+            LIMIT 1
+            FOR UPDATE
+            """
+    cursor.execute(query, (chat_id,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def lock_pending_applications(cursor, session_id, uids):
+    # The pending applications among uids, in the order they were given, locked until the transaction ends so a
+    # concurrent accept or reject can't move them too
+    placeholders = ", ".join(["%s"] * len(uids))
+    query = f"""
+            SELECT uid FROM applications
+            WHERE session_id = %s AND uid IN ({placeholders}) AND app_status = 'pending'
+            FOR UPDATE
+            """
+    cursor.execute(query, (session_id, *uids))
+    pending = {row[0] for row in cursor.fetchall()}
+    return [uid for uid in uids if uid in pending]
+
+
+def reserve_slots(cursor, session_id, wanted):
+    # Takes up to wanted slots in one conditional update and returns how many it got, so trainers_needed can never go
+    # below zero however many accepts run at once. LAST_INSERT_ID(expr) hands the number taken back in the same round
+    # trip, as the cursor's lastrowid, which only means anything if exactly one job was updated.
+    if wanted == 0:
+        return 0
+    query = """
+            UPDATE jobs
+            SET trainers_needed = trainers_needed - LAST_INSERT_ID(LEAST(trainers_needed, %s))
+            WHERE session_id = %s AND job_status = 'incomplete' AND trainers_needed > 0
+            """
+    cursor.execute(query, (wanted, session_id))
+    if cursor.rowcount == 0:
+        return 0
+    if cursor.rowcount != 1:
+        raise mysql.connector.Error(f"Reserving slots updated {cursor.rowcount} jobs for programme {session_id}")
+    return cursor.lastrowid
+
+
+def release_slots(cursor, session_id, count):
+    query = "UPDATE jobs SET trainers_needed = trainers_needed + %s WHERE session_id = %s"
+    cursor.execute(query, (count, session_id))
+
+
+def update_application_statuses(cursor, session_id, uids, new_status, columns):
+    # Moves every pending application in uids to new_status in one statement, then reads them all back in one query.
+    # uids should come from lock_pending_applications for the same session_id, so only the applications that really
+    # changed are read back, never a trainer's applications to earlier programmes in the same chat.
+    placeholders = ", ".join(["%s"] * len(uids))
+    query = f"""
+            UPDATE applications
+            SET app_status = %s
+            WHERE session_id = %s 
+            AND uid IN ({placeholders}) 
+            AND app_status = 'pending'
+            """
+    cursor.execute(query, (new_status, session_id, *uids))
 
-            if result:
-                programme_name, school, prog_date, start_time, hours, telegram_id = result
+    # Retrieve application data
+    select_query = f"""
+                   SELECT {columns}
+                   FROM applications
+                   WHERE session_id = %s AND uid IN ({placeholders}) AND app_status = %s
+                   """
+    cursor.execute(select_query, (session_id, *uids, new_status))
+    return JobApplication.all(cursor)
 
-                # Export Telegram group invite link
-                try:
-                    join_link = await bot.export_chat_invite_link(chat_id)
-                except Exception as e:
-                    logging.error(f"Error exporting chat invite link: {e}")
-                    join_link = "Unavailable"
-
-                # Send a direct message
-                formatted_time_f = (datetime.min + start_time).strftime('%I:%M %p') \
-                    if isinstance(start_time, timedelta) \
-                    else str(start_time)
-                message = (f"Good news! You have been confirmed for {programme_name} at {school} on"
-                           f" {prog_date.strftime('%d %b %y')} starting at {formatted_time_f} for {hours} hours."
-                           f" Please click the link to join the programme chat group:\n{join_link}")
-                await bot.send_message(chat_id=telegram_id, text=message)
-            else:
-                logging.warning("No matching record found")
 
-        except mysql.connector.Error as e:
-            print(f"Error updating application statuses: {e}")
-        finally:
-            if cursor is not None:
-                cursor.close()
-            if connection.is_connected():
-                connection.close()
+def accepted_message(app, join_link):
+    message = (f"Good news! You have been confirmed for {app.programme_name} at {app.school} on {app.date_text}"
+               f" starting at {app.time_text} for {app.hours} hours."
+               f" Please click the link to join the programme chat group:\n{join_link}")
+    return app.telegram_id, message, app.uid
 
 
 #  COMMAND - REJECT APPLICATIONS
@@ -1535,7 +2877,7 @@ async def app_reject_button(update, context):
         return
 
     # Verify if the user is a manager
-    if not is_user_manager(user_id):
+    if not await is_user_manager(user_id):
         await context.bot.send_message(chat_id=query.message.chat_id, text="You must be a manager to use this command.")
         return
 
@@ -1571,63 +2913,44 @@ async def reject_applicants(update, context):
         await update.message.reply_text(str(e))
         return
 
-    # Update the database and send notifications
-    for uid in uids:
-        await update_reject_application(bot, chat_id, uid)
+    # Update the database in one transaction, then send notifications
+    results = await run_db(reject_applications, chat_id, uids)
+    if results is None:
+        await context.bot.send_message(chat_id=chat_id, text="Sorry something went wrong, nobody was rejected. Please"
+                                                             " try again.")
+        return ConversationHandler.END
+
+    notifier.send_batch([rejected_message(result) for result in results],
+                        on_complete=delivery_reporter(context.bot, chat_id, "Rejections"))
 
-    await context.bot.send_message(chat_id=chat_id, text="Applicant(s) have been rejected.")
+    await context.bot.send_message(chat_id=chat_id, text=f"{len(results)} applicant(s) have been rejected.")
     # Clear all existing data from context.user_data
     context.user_data.clear()
     return ConversationHandler.END
 
 
-async def update_reject_application(bot, chat_id, uid):
-    connection = create_db_connection()
-    cursor = None
-    if connection is not None:
-        try:
-            # Update application status
-            cursor = connection.cursor()
-            query = """
-                    UPDATE applications
-                    SET app_status = 'rejected'
-                    WHERE chat_id = %s 
-                    AND uid = %s 
-                    AND app_status = 'pending'
-                    """
-            cursor.execute(query, (chat_id, uid))
-            connection.commit()
+def reject_applications(chat_id, uids):
+    uids = list(dict.fromkeys(uids))
+    try:
+        with UnitOfWork() as uow:
+            session_id = lock_open_programme(uow.cursor, chat_id)
+            pending = lock_pending_applications(uow.cursor, session_id, uids) if session_id is not None else []
+            if len(pending) < len(uids):
+                logging.warning(f"No pending application found for {len(uids) - len(pending)} UID(s)")
+            if not pending:
+                return []
+            return update_application_statuses(uow.cursor, session_id, pending, 'rejected',
+                                               "programme_name, school, prog_date, start_time, telegram_id, uid")
+    except mysql.connector.Error as e:
+        print(f"Error updating application statuses: {e}")
+        return None
 
-            # Retrieve application data
-            select_query = """
-                                           SELECT programme_name, school, prog_date, start_time, telegram_id
-                                           FROM applications
-                                           WHERE chat_id = %s AND uid = %s
-                                           """
-            cursor.execute(select_query, (chat_id, uid))
-            result = cursor.fetchone()
 
-            if result:
-                programme_name, school, prog_date, start_time, telegram_id = result
-
-                # Send a direct message
-                formatted_time_e = (datetime.min + start_time).strftime('%I:%M %p') \
-                    if isinstance(start_time, timedelta) \
-                    else str(start_time)
-                message = (f"Hello! You have been released from {programme_name} at {school} on"
-                           f" {prog_date.strftime('%d %b %y')} starting at {formatted_time_e}."
-                           f" Thanks for signing up and I hope we get to do the next one!")
-                await bot.send_message(chat_id=telegram_id, text=message)
-            else:
-                logging.warning("No matching record found")
-
-        except mysql.connector.Error as e:
-            print(f"Error updating application statuses: {e}")
-        finally:
-            if cursor is not None:
-                cursor.close()
-            if connection.is_connected():
-                connection.close()
+def rejected_message(app):
+    message = (f"Hello! You have been released from {app.programme_name} at {app.school} on {app.date_text}"
+               f" starting at {app.time_text}."
+               f" Thanks for signing up and I hope we get to do the next one!")
+    return app.telegram_id, message, app.uid
 
 
 # CONVERSATION 6 - USER VIEWING THEIR OWN APPLICATIONS PERHAPS WITHDRAWING
@@ -1643,8 +2966,8 @@ async def view_user_apps(update, context):
         return ConversationHandler.END
 
     user_id = query.from_user.id
-    applications = fetch_user_applications(user_id)  # Fetch applications from DB
-    await context.bot.send_message(chat_id=query.message.chat_id, text=applications)
+    applications, nav = await show_page(user_application_listing, (user_id,))  # Fetch applications from DB
+    await context.bot.send_message(chat_id=query.message.chat_id, text=applications, reply_markup=page_markup(nav))
 
     # Display options to the user
     keyboard = [
@@ -1657,43 +2980,28 @@ async def view_user_apps(update, context):
     return USER_OPTIONS  # Going either to home or withdraw
 
 
-def fetch_user_applications(user_id):
-    connection = create_db_connection()
-    cursor = None
-    if connection is not None:
-        try:
-            cursor = connection.cursor()
-            query = """
-                    SELECT session_id, programme_name, school, prog_date, start_time, hours, app_status
-                    FROM applications
-                    WHERE telegram_id = %s AND app_status IN ('accepted', 'pending')
-                    """
-            cursor.execute(query, (user_id,))
-            applications = cursor.fetchall()
-
-            if not applications:
-                return "You have no applications."
-
-            applications_info = "Your Programmes:\n\n"
-            for app in applications:
-                session_id, programme_name, school, prog_date, start_time, hours, app_status = app
-                formatted_time_d = (datetime.min + start_time).strftime('%I:%M %p') \
-                    if isinstance(start_time, timedelta) \
-                    else str(start_time)
-                applications_info += (f"ID Number: {session_id}\n\t• Programme: {programme_name}\n\t• School:"
-                                      f" {school}\n\t• Date: {prog_date.strftime('%d-%m-%y')}\n\t• Time:"
-                                      f" {formatted_time_d}\n\t• Hours: {hours}\n\t• Status: {app_status}\n\n")
-            return applications_info
-
-        except mysql.connector.Error as e:
-            return f"Error retrieving applications: {e}"
-        finally:
-            if cursor is not None:
-                cursor.close()
-            if connection.is_connected():
-                connection.close()
-    else:
-        return "Failed to connect to the database."
+def format_user_application_row(app):
+    return (f"ID Number: {app.session_id}\n\t• Programme: {app.programme_name}\n\t• School:"
+            f" {app.school}\n\t• Date: {app.date_digits}\n\t• Time:"
+            f" {app.time_text}\n\t• Hours: {app.hours}\n\t• Status: {app.app_status}\n\n")
+
+
+user_application_listing = Listing(
+    'myapps',
+    select="""
+            SELECT session_id, programme_name, school, prog_date, start_time, hours, app_status
+            FROM applications
+            WHERE telegram_id = %s AND app_status IN ('accepted', 'pending')
+            """,
+    model=JobApplication,
+    key_columns=('prog_date', 'session_id'),
+    key=lambda app: (app.prog_date, app.session_id),
+    header=lambda params: "Your Programmes:\n\n",
+    format_row=format_user_application_row,
+    empty="You have no applications.",
+    error="Error retrieving applications.",
+    scope=lambda query, arg: (query.from_user.id,),
+)
 
 
 async def handle_go_home(update, context):
@@ -1760,7 +3068,7 @@ async def withdrawing_app(update, context):
     user_id = update.message.from_user.id
 
     # Show application details for user to confirm
-    message_app_check = fetch_one_app(session_id, user_id)
+    message_app_check = await run_db(fetch_one_app, session_id, user_id)
     await update.message.reply_text("Please confirm that this is the programme you are withdrawing from.")
     await update.message.reply_text(message_app_check)
     await update.message.reply_text("If this is correct, please enter the ID Number again. If not, /cancel and"
@@ -1780,25 +3088,19 @@ def fetch_one_app(session_id, user_id):
             WHERE session_id = %s AND telegram_id = %s
             """
             cursor.execute(query, (session_id, user_id))
-            job = cursor.fetchone()
+            app = JobApplication.one(cursor)
 
-            if not job:
+            if not app:
                 return "Ah wait there is no signup with this ID though."
-            programme, school, prog_date, start_time, hours = job
-            # Check if job[4] is a timedelta object and format it
-            formatted_time_g = (datetime.min + start_time).strftime('%I:%M %p') \
-                if isinstance(start_time, timedelta) \
-                else str(start_time)
-            message_fetch_job = (f"Programme: {programme}\nSchool: {school}\nDate:"
-                                 f" {prog_date.strftime('%d-%m-%y')}\nTime: {formatted_time_g}\nHours: {hours}\n")
+            message_fetch_job = (f"Programme: {app.programme_name}\nSchool: {app.school}\nDate:"
+                                 f" {app.date_digits}\nTime: {app.time_text}\nHours: {app.hours}\n")
             return message_fetch_job
         except Error as e:
             return "Error retrieving programme details.", e
         finally:
             if cursor is not None:
                 cursor.close()
-            if connection.is_connected():
-                connection.close()
+            connection.close()
     else:
         return "Failed to connect to the database."
 
@@ -1826,66 +3128,52 @@ async def confirm_withdraw(update, context):
 
 
 async def withdraw_application_accepted(session_id, telegram_id):
-    connection = create_db_connection()
-    cursor = None
-    if connection is not None:
-        try:
-            cursor = connection.cursor()
+    message_withdraw, dropout = await run_db(withdraw_application, session_id, telegram_id)
 
-            # Check if there is an accepted application first
-            select_query = """
-            SELECT session_id 
-            FROM applications 
-            WHERE session_id = %s AND telegram_id = %s AND app_status = 'accepted'
-            """
-            cursor.execute(select_query, (session_id, telegram_id))
-            temp_sesh_id_result = cursor.fetchone()
+    if dropout:
+        # Send a message into chat
+        message = (f"Bad news, someone dropped out: {dropout.first_name} {dropout.last_name} (ID: {dropout.uid})."
+                   f" Applications open again.")
+        notifier.send_batch([(dropout.chat_id, message, dropout.uid)])
 
-            if temp_sesh_id_result:
-                temp_sesh_id = temp_sesh_id_result[0]
+    return message_withdraw
 
-                # Update the trainers_needed field in the jobs table for accepted applications
-                update_app_query = "UPDATE jobs SET trainers_needed = trainers_needed + 1 WHERE session_id = %s"
-                cursor.execute(update_app_query, (temp_sesh_id,))
 
-            # Update the application status to 'withdrawn' for both accepted and pending applications
+def withdraw_application(session_id, telegram_id):
+    try:
+        with UnitOfWork() as uow:
+            cursor = uow.cursor
+
+            # Only the statement that actually moves an accepted application hands its slot back, so two withdrawals
+            # racing each other can't both give it back
+            update_accepted_query = """
+            UPDATE applications SET app_status = 'withdrawn'
+            WHERE session_id = %s AND telegram_id = %s AND app_status = 'accepted'
+            """
+            cursor.execute(update_accepted_query, (session_id, telegram_id))
+            freed = cursor.rowcount
+            if freed:
+                release_slots(cursor, session_id, freed)
+
+            # Update the application status to 'withdrawn' for pending applications too
             update_query = "UPDATE applications SET app_status = 'withdrawn' WHERE session_id = %s AND telegram_id = %s"
             cursor.execute(update_query, (session_id, telegram_id))
 
-            connection.commit()
-
-            if temp_sesh_id_result:
-                temp_sesh_id = temp_sesh_id_result[0]
+            if freed:
+                # The slot freed up can put the programme back in the listing
+                uow.on_commit(listing_cache.bump)
 
                 # Select the chat_id from the session_id
                 select_query = """
                 SELECT chat_id, first_name, last_name, uid 
                 FROM applications WHERE session_id = %s AND telegram_id = %s
                 """
-                cursor.execute(select_query, (temp_sesh_id, telegram_id))
-                temp_results = cursor.fetchone()
+                cursor.execute(select_query, (session_id, telegram_id))
+                return "Application withdrawn and trainers_needed updated.", JobApplication.one(cursor)
+            return "Application withdrawn.", None
 
-                chat_id, first_name, last_name, uid = temp_results
-
-                # Send a message into chat
-                temp_chat_id = chat_id
-                message = (f"Bad news, someone dropped out: {first_name} {last_name} (ID: {uid}). Applications"
-                           f" open again.")
-                await bot.send_message(chat_id=temp_chat_id, text=message)
-
-                return "Application withdrawn and trainers_needed updated."
-            else:
-                return "Application withdrawn."
-
-        except mysql.connector.Error as e:
-            return f"Error in processing withdrawal: {e}"
-        finally:
-            if cursor is not None:
-                cursor.close()
-            if connection.is_connected():
-                connection.close()
-    else:
-        return "Failed to connect to the database."
+    except mysql.connector.Error as e:
+        return f"Error in processing withdrawal: {e}", None
 
 
 # COMMAND - MANAGER VIEWS PHOTO
@@ -1898,7 +3186,7 @@ async def send_user_photo(update, context):
     user_id = update.message.from_user.id
 
     # Verify if the user is a manager
-    if not is_user_manager(user_id):
+    if not await is_user_manager(user_id):
         await context.bot.send_message(chat_id=user_id, text="You must be a manager to use this command.")
         return
 
@@ -1907,31 +3195,90 @@ async def send_user_photo(update, context):
         args = context.args
         if not args or not args[0].isdigit():
             raise ValueError
-        u_id = args[0]
+        u_id = int(args[0])
     except ValueError:
         await update.message.reply_text("Usage: /seephoto <ID Number>")
         return
 
+    # Resend by file_id whenever Telegram already has the photo, only upload on a miss
+    file_id = photo_file_ids.get(u_id)
+    if file_id is not None:
+        try:
+            await context.bot.send_photo(chat_id=user_id, photo=file_id)
+            return
+        except BadRequest:
+            photo_file_ids.pop(u_id)
+
+    try:
+        photo_result = await run_db(fetch_user_photo, u_id)
+    except mysql.connector.Error as e:
+        await context.bot.send_message(chat_id=user_id, text=f"Error retrieving photo: {e}")
+        return
+
+    if not photo_result:
+        await context.bot.send_message(chat_id=user_id, text="No photo found.")
+        return
+
+    photo_ref, photo_file_id, photo_blob = photo_result
+    if photo_file_id and photo_file_id != file_id:
+        try:
+            await context.bot.send_photo(chat_id=user_id, photo=photo_file_id)
+            photo_file_ids.put(u_id, photo_file_id)
+            return
+        except BadRequest:
+            pass
+
+    if photo_ref and photo_store.exists(photo_ref):
+        photo = Path(photo_store.path_for(photo_ref))
+    else:
+        photo = photo_blob
+    if not photo:
+        await context.bot.send_message(chat_id=user_id, text="No photo found.")
+        return
+
+    message = await context.bot.send_photo(chat_id=user_id, photo=photo)
+    new_file_id = message.photo[-1].file_id
+    photo_file_ids.put(u_id, new_file_id)
+    await run_db(store_photo_file_id, u_id, new_file_id)
+
+
+def fetch_user_photo(u_id):
     connection = create_db_connection()
     cursor = None
     if connection is not None:
         try:
             cursor = connection.cursor()
-            query = "SELECT photo FROM users WHERE uid = %s"
+            query = "SELECT photo_ref, photo_file_id FROM users WHERE uid = %s"
             cursor.execute(query, (u_id,))
-            photo_result = cursor.fetchone()
+            result = cursor.fetchone()
+            if result is None:
+                return None
+            photo_ref, photo_file_id = result
+            if photo_ref is None and photo_file_id is None:
+                # Not moved out of the users table yet, see migrate.py
+                cursor.execute("SELECT photo FROM users WHERE uid = %s", (u_id,))
+                return None, None, cursor.fetchone()[0]
+            return photo_ref, photo_file_id, None
+        finally:
+            if cursor is not None:
+                cursor.close()
+            connection.close()
 
-            if photo_result and photo_result[0]:
-                await context.bot.send_photo(chat_id=user_id, photo=photo_result[0])
-            else:
-                await context.bot.send_message(chat_id=user_id, text="No photo found.")
-        except mysql.connector.Error as e:
-            await context.bot.send_message(chat_id=user_id, text=f"Error retrieving photo: {e}")
+
+def store_photo_file_id(u_id, file_id):
+    connection = create_db_connection()
+    cursor = None
+    if connection is not None:
+        try:
+            cursor = connection.cursor()
+            cursor.execute("UPDATE users SET photo_file_id = %s WHERE uid = %s", (file_id, u_id))
+            connection.commit()
+        except Error as e:
+            print("Error while saving photo file_id", e)
         finally:
             if cursor is not None:
                 cursor.close()
-            if connection.is_connected():
-                connection.close()
+            connection.close()
 
 
 # CONVERSATION 7 - COMPLETING A PROGRAMME
@@ -1963,46 +3310,33 @@ async def yes_complete_handle(update, context):
     await query.answer()
 
     chat_id = update.callback_query.message.chat_id
-    message_trainer_check = fetch_trainers(chat_id)
+    message_trainer_check, nav = await show_page(trainer_listing, (chat_id,))
 
     await query.edit_message_reply_markup(reply_markup=None)
     await context.bot.send_message(chat_id=query.message.chat_id,
                                    text="Okay! Great job team! Let me confirm: Which of these persons were NOT in the"
                                         " programme? (Enter their ID numbers; 0 if none)")
-    await context.bot.send_message(chat_id=query.message.chat_id, text=message_trainer_check)
+    await context.bot.send_message(chat_id=query.message.chat_id, text=message_trainer_check,
+                                   reply_markup=page_markup(nav))
     return ANY_REMOVALS
 
 
-def fetch_trainers(chat_id):
-    connection = create_db_connection()
-    cursor = None
-    if connection is not None:
-        try:
-            cursor = connection.cursor()
-            query = """
-            SELECT first_name, last_name, uid FROM applications 
-            WHERE chat_id = %s AND app_status = 'accepted' 
-            """
-            cursor.execute(query, (chat_id,))
-            trainers = cursor.fetchall()
-
-            if not trainers:
-                return "No trainers confirmed for this programme."
-
-            message_fetch_trainers = f"Listing all persons:\n\n"
-            for trainer in trainers:
-                message_fetch_trainers += f"• {trainer[0]} {trainer[1]} ({trainer[2]})\n\n"
-            return message_fetch_trainers
-
-        except Error as e:
-            return "Error retrieving list of associates.", e
-        finally:
-            if cursor is not None:
-                cursor.close()
-            if connection.is_connected():
-                connection.close()
-    else:
-        return "Failed to connect to the database."
+trainer_listing = Listing(
+    'trainers',
+    # The trainers of the programme that completing will close and credit, not of earlier ones in the same chat
+    select=f"""
+    SELECT first_name, last_name, uid FROM applications 
+    WHERE session_id = {OPEN_PROGRAMME_IN_CHAT} AND app_status = 'accepted' 
+    """,
+    model=JobApplication,
+    key_columns=('uid',),
+    key=lambda trainer: (trainer.uid,),
+    header=lambda params: "Listing all persons:\n\n",
+    format_row=lambda trainer: f"• {trainer.first_name} {trainer.last_name} ({trainer.uid})\n\n",
+    empty="No trainers confirmed for this programme.",
+    error="Error retrieving list of associates.",
+    scope=lambda query, arg: (query.message.chat_id,),
+)
 
 
 async def no_incomplete_handle(update, context):
@@ -2052,12 +3386,11 @@ async def trainer_removals(update, context):
         return
 
     # Update the database
-    for uid in uids:
-        update_completed_accepts_to_removed(chat_id, uid)
+    await run_db(remove_trainers, chat_id, uids)
 
     await update.message.reply_text("Records have been updated. Check one more time?")
-    message_trainer_check2 = fetch_trainers(chat_id)
-    await update.message.reply_text(message_trainer_check2)
+    message_trainer_check2, nav = await show_page(trainer_listing, (chat_id,))
+    await update.message.reply_text(message_trainer_check2, reply_markup=page_markup(nav))
     keyboard = [
         [InlineKeyboardButton("Confirm list", callback_data='double_confirm_list')],
         [InlineKeyboardButton("Made an oops, need to do again", callback_data='start_over')],
@@ -2068,21 +3401,24 @@ async def trainer_removals(update, context):
     return CONFIRM_ALL_PROG_DEETS
 
 
-def update_completed_accepts_to_removed(chat_id, uid):
-    connection = create_db_connection()
-    cursor = None
+def remove_trainers(chat_id, uids):
     try:
-        cursor = connection.cursor()
-        update_query = "UPDATE applications SET app_status = 'removed' WHERE chat_id = %s AND uid = %s"
-        cursor.execute(update_query, (chat_id, uid))
-        connection.commit()
+        with UnitOfWork() as uow:
+            session_id = lock_open_programme(uow.cursor, chat_id)
+            if session_id is not None:
+                update_completed_accepts_to_removed(uow.cursor, session_id, uids)
     except Error as e:
         print(f"Error updating job status: {e}")
-    finally:
-        if cursor is not None:
-            cursor.close()
-        if connection.is_connected():
-            connection.close()
+
+
+def update_completed_accepts_to_removed(cursor, session_id, uids):
+    # Only the accepted trainers of the programme being completed, their other applications are left as they are
+    placeholders = ", ".join(["%s"] * len(uids))
+    update_query = f"""
+        UPDATE applications SET app_status = 'removed'
+        WHERE session_id = %s AND uid IN ({placeholders}) AND app_status = 'accepted'
+    """
+    cursor.execute(update_query, (session_id, *uids))
 
 
 async def completion_confirm_button(update, context):
@@ -2091,84 +3427,67 @@ async def completion_confirm_button(update, context):
 
     chat_id = update.callback_query.message.chat_id
 
-    update_training_hours(chat_id)
-
-    update_job_status(chat_id)
+    credited = await run_db(complete_programme, chat_id)
 
     await query.edit_message_reply_markup(reply_markup=None)
+    if credited is None:
+        await context.bot.send_message(chat_id=query.message.chat_id,
+                                       text="Sorry something went wrong, the programme is still open. Please try"
+                                            " again.")
+        return ConversationHandler.END
+    # Nobody else should be joining a closed programme
+    await invite_links.invalidate(context.bot, chat_id, revoke=True)
+    if credited is False:
+        await context.bot.send_message(chat_id=query.message.chat_id,
+                                       text="This programme has already been closed, nothing was changed.")
+        return ConversationHandler.END
     await context.bot.send_message(chat_id=query.message.chat_id,
-                                   text="All done! Training hours updated and programme closed.")
+                                   text=f"All done! Training hours updated for {credited} trainer(s) and programme"
+                                        f" closed.")
     return ConversationHandler.END
 
 
-def update_training_hours(chat_id):
-    connection = create_db_connection()
-    cursor = None
-    if connection is not None:
-        try:
-            cursor = connection.cursor()
-
-            # (1) Select uids from applications table
-            select_uids_query = """
-                SELECT uid FROM applications 
-                WHERE chat_id = %s AND app_status = 'accepted'
-            """
-            cursor.execute(select_uids_query, (chat_id,))
-            uids = [item[0] for item in cursor.fetchall()]
-
-            if not uids:
-                return "No UIDs found from SQLapps, please check with Tim on this error."
-
-            # (2) Select hours from jobs table
-            select_hours_query = """
-                SELECT hours FROM jobs 
-                WHERE chat_id = %s
-            """
-            cursor.execute(select_hours_query, (chat_id,))
-            hours_result = cursor.fetchone()
-            if hours_result:
-                hours = hours_result[0]
-            else:
-                return "No hours found from SQLjobs, please check with Tim on this error."
-
-            # (3) Update training_hours in users table
-            for uid in uids:
-                update_hours_query = """
-                    UPDATE users 
-                    SET training_hours = training_hours + %s 
-                    WHERE uid = %s
-                """
-                cursor.execute(update_hours_query, (hours, uid))
-
-            connection.commit()
-            return "Training hours updated successfully."
-
-        except Error as e:
-            return f"Error updating training hours: {e}"
-        finally:
-            if cursor is not None:
-                cursor.close()
-            if connection.is_connected():
-                connection.close()
-    else:
-        return "Failed to connect to the database."
-
-
-def update_job_status(chat_id):
-    connection = create_db_connection()
-    cursor = None
+def complete_programme(chat_id):
+    # Returns how many trainers were credited, False if the programme was already closed, or None on error
     try:
-        cursor = connection.cursor()
-        update_query = "UPDATE jobs SET job_status = 'complete' WHERE chat_id = %s"
-        cursor.execute(update_query, (chat_id,))
-        connection.commit()
+        with UnitOfWork() as uow:
+            credited = close_programme(uow.cursor, chat_id)
+            if credited is not False:
+                uow.on_commit(listing_cache.bump)
+            return credited
     except Error as e:
-        print(f"Error updating job status: {e}")
-    finally:
-        if cursor is not None:
-            cursor.close()
-        if connection.is_connected():
-            connection.close()
+        print(f"Error updating training hours: {e}")
+        return None
+
+
+def close_programme(cursor, chat_id):
+    # The chat's open programme is picked and locked first, then closed and credited by its session_id, so another
+    # programme open in the same chat is left alone rather than closed uncredited. Closing the job is the gate: only an
+    # incomplete job matches, so a second run (eg. a double tapped "Confirm list") finds nothing open and credits
+    # nobody twice, and concurrent runs queue on the job's row lock.
+    session_id = lock_open_programme(cursor, chat_id)
+    if session_id is None:
+        return False
+    close_query = "UPDATE jobs SET job_status = 'complete' WHERE session_id = %s AND job_status = 'incomplete'"
+    cursor.execute(close_query, (session_id,))
+    if cursor.rowcount != 1:
+        return False
+    # No more sign ups for it; if the transaction rolls back the programme is simply fetched again
+    programme_cache.invalidate(session_id)
+
+    # One ledger row per accepted trainer, whatever the number of trainers
+    credit_query = """
+        INSERT INTO hours_ledger (uid, session_id, hours)
+        SELECT a.uid, j.session_id, j.hours
+        FROM jobs j
+        JOIN applications a ON a.session_id = j.session_id AND a.app_status = 'accepted'
+        WHERE j.session_id = %s
+    """
+    cursor.execute(credit_query, (session_id,))
+    credited = cursor.rowcount
+    if credited:
+        add_to_hours_totals(cursor, session_id)
+    return credited
 
 
 async def start_over_complete(update, context):
@@ -2185,8 +3504,7 @@ async def default_response(update, context):
     user_id = update.message.from_user.id
 
     try:
-        member = await context.bot.get_chat_member(ASSOC_CHAT_ID, user_id)
-        if member.status in ['member', 'administrator', 'creator']:
+        if await is_associate(context.bot, user_id):
             keyboard = [
                 [InlineKeyboardButton("Show me", callback_data='home')]
             ]
@@ -2203,20 +3521,455 @@ async def default_response(update, context):
             " https://halogen.sg/halogenplus-volunteer/ to sign up!")
 
 
+# TRAINING HOURS LEDGER
+# Every credit is a row in hours_ledger, one per (trainer, programme), and hours_totals keeps each trainer's running
+# total, updated in the same transaction as the credit, so nothing has to be summed to show a total. Corrections are
+# made by adding ledger rows (session_id NULL, with a note), never by editing them. The reconciler walks the ledger a
+# batch of trainers at a time and fixes any total that has drifted from it, eg. after a correction.
+HOURS_RECONCILE_INTERVAL = float(os.getenv('HOURS_RECONCILE_INTERVAL', '300'))
+HOURS_RECONCILE_BATCH = int(os.getenv('HOURS_RECONCILE_BATCH', '200'))
+
+
+def add_to_hours_totals(cursor, session_id):
+    query = """
+        INSERT INTO hours_totals (uid, total_hours, entries, last_entry_id)
+        SELECT uid, hours, 1, entry_id FROM hours_ledger WHERE session_id = %s
+        ON DUPLICATE KEY UPDATE total_hours = total_hours + VALUES(total_hours),
+                                entries = entries + 1,
+                                last_entry_id = GREATEST(last_entry_id, VALUES(last_entry_id))
+    """
+    cursor.execute(query, (session_id,))
+
+
+class HoursReconciler:
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.last_uid = 0  # where the next batch starts, back to 0 after the last batch
+
+    def step(self):
+        # Checks one batch of trainers and returns how many totals were fixed
+        try:
+            with UnitOfWork() as uow:
+                cursor = uow.cursor
+                query = """
+                    SELECT l.uid, SUM(l.hours), COUNT(*), MAX(l.entry_id),
+                           MAX(t.total_hours), MAX(t.entries), MAX(t.last_entry_id)
+                    FROM hours_ledger l
+                    LEFT JOIN hours_totals t ON t.uid = l.uid
+                    WHERE l.uid > %s
+                    GROUP BY l.uid
+                    ORDER BY l.uid
+                    LIMIT %s
+                """
+                cursor.execute(query, (self.last_uid, self.batch_size))
+                rows = cursor.fetchall()
+                self.last_uid = rows[-1][0] if len(rows) == self.batch_size else 0
+
+                fixed = 0
+                for uid, total, entries, last_entry_id, seen_total, seen_entries, seen_last_entry_id in rows:
+                    if (total, entries, last_entry_id) == (seen_total, seen_entries, seen_last_entry_id):
+                        continue
+                    logger.warning(f"Training hours total for uid {uid} was {seen_total}, ledger says {total}")
+                    if seen_total is None:
+                        cursor.execute("""
+                            INSERT INTO hours_totals (uid, total_hours, entries, last_entry_id)
+                            VALUES (%s, %s, %s, %s)
+                            ON DUPLICATE KEY UPDATE uid = uid
+                        """, (uid, total, entries, last_entry_id))
+                    else:
+                        # Only if the row is still as it was read, a credit landing in between is left for next time
+                        cursor.execute("""
+                            UPDATE hours_totals SET total_hours = %s, entries = %s, last_entry_id = %s
+                            WHERE uid = %s AND total_hours = %s AND entries = %s AND last_entry_id = %s
+                        """, (total, entries, last_entry_id, uid, seen_total, seen_entries, seen_last_entry_id))
+                    fixed += cursor.rowcount
+                return fixed
+        except Error as e:
+            print(f"Error reconciling training hours: {e}")
+            return 0
+
+
+hours_reconciler = HoursReconciler(HOURS_RECONCILE_BATCH)
+
+
+async def reconcile_hours():
+    fixed = await run_db(hours_reconciler.step)
+    if fixed:
+        logger.warning(f"Fixed {fixed} training hours total(s)")
+
+
+def format_hours_row(entry):
+    if entry.programme_name:
+        return f"• {entry.date_text} - {entry.programme_name} at {entry.school}: {entry.hours} hours\n"
+    return f"• {entry.credited_text} - {entry.note or 'Adjustment'}: {entry.hours} hours\n"
+
+
+hours_history_listing = Listing(
+    'hours',
+    select="""
+    SELECT l.entry_id, l.hours, l.credited_at, j.programme_name, j.school, j.prog_date, l.note
+    FROM hours_ledger l
+    JOIN users u ON u.uid = l.uid
+    LEFT JOIN jobs j ON j.session_id = l.session_id
+    WHERE u.telegram_id = %s
+    """,
+    model=HoursEntry,
+    key_columns=('l.entry_id',),
+    key=lambda entry: (entry.entry_id,),
+    header=lambda params: "Training hours history:\n\n",
+    format_row=format_hours_row,
+    empty="No training hours recorded yet.",
+    error="Error retrieving training hours.",
+    scope=lambda query, arg: (query.from_user.id,),
+    descending=True,
+)
+
+
+# CONVERSATION LIFECYCLE
+# Idle conversations are ended by ConversationHandler's conversation_timeout, run on the JobQueue. Timeouts can be
+# overridden with CONVERSATION_TIMEOUT_<NAME>; conversations restored on startup that were already idle past theirs
+# are dropped as they load. Every update stamps its (chat, user) key, and the sweeper drops the user_data of anyone who
+# has been quiet for longer than the longest timeout and isn't in a conversation.
+CONVERSATION_SWEEP_INTERVAL = float(os.getenv('CONVERSATION_SWEEP_INTERVAL', '60'))
+conversation_activity = {}  # (chat_id, user_id) -> last update time
+conversation_timeouts = {}  # conversation name -> seconds
+
+
+def conversation_timeout(name, default):
+    timeout = float(os.getenv(f'CONVERSATION_TIMEOUT_{name.upper()}', default))
+    conversation_timeouts[name] = timeout
+    return timeout
+
+
+async def touch_conversation(update, context):
+    if update.effective_chat and update.effective_user:
+        conversation_activity[(update.effective_chat.id, update.effective_user.id)] = time.monotonic()
+
+
+async def registration_timed_out(update, context):
+    # The draft, and its photo, go with the conversation
+    registration_drafts.discard(update.effective_user.id)
+
+
+async def sweep_user_data(application):
+    now = time.monotonic()
+    # Anyone still in a conversation keeps their user_data, the conversation's next step reads it. That includes
+    # conversations restored on startup, which have no timeout job.
+    active_users = {key[-1] for keys in persistence.conversations.values() for key in keys}
+
+    idle_after = max(conversation_timeouts.values(), default=0)
+    for key, last_seen in list(conversation_activity.items()):
+        if now - last_seen > idle_after:
+            del conversation_activity[key]
+        else:
+            active_users.add(key[-1])
+    for user_id in list(application.user_data):
+        if user_id not in active_users:
+            application.drop_user_data(user_id)
+
+
+def conversation_stats(application):
+    stats = {name: len(persistence.conversations.get(name, ())) for name in conversation_timeouts}
+    stats['user_data'] = len(application.user_data)
+    stats['registration_drafts'] = len(registration_drafts)
+    stats['tracked_keys'] = len(conversation_activity)
+    stats.update(update_processor.metrics())
+    return stats
+
+
+async def state_stats(update, context):
+    # Check if the user who sent this command is the admin
+    if update.message.from_user.id != ADMIN_USER_ID:
+        await update.message.reply_text("You don't have permission to use this command.")
+        return
+
+    stats = conversation_stats(context.application)
+    message_stats = "Conversation state:\n\n" + "".join(f"• {key}: {value}\n" for key, value in stats.items())
+    await update.message.reply_text(message_stats)
+
+
+# ERRORS
+async def error_handler(update, context):
+    if isinstance(context.error, asyncio.TimeoutError):
+        logger.warning(f"DB query timed out while handling {update}")
+        if isinstance(update, Update) and update.effective_chat:
+            await context.bot.send_message(chat_id=update.effective_chat.id,
+                                           text="Sorry, that is taking too long! Please try again in a bit.")
+        return
+    logger.error("Exception while handling an update", exc_info=context.error)
+
+
+async def on_startup(application):
+    if LEADER_ELECTION:
+        loop = asyncio.get_running_loop()
+        leader.keep_alive(lambda: loop.call_soon_threadsafe(application.stop_running))
+    await notifier.start(application.bot)
+    registration_drafts.load(await persistence.load_kind('registration_draft'))
+    try:
+        await run_db(role_cache.load)
+        await run_db(registered_users.refresh)
+    except asyncio.TimeoutError:
+        logger.warning("Timed out warming caches, will retry on the next refresh")
+    for interval, func in periodic_jobs:
+        background_tasks.append(asyncio.create_task(run_periodically(interval, func)))
+
+
+async def on_shutdown(application):
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await notifier.stop()
+    # A periodic write cancelled above put its batch back, write it out before the executor goes
+    await persistence.flush()
+    db_executor.shutdown(wait=False, cancel_futures=True)
+    # Only let go of the lock once everything has been flushed, so the next leader sees it (nothing is flushed once
+    # leadership has been lost, see MySQLPersistence.write_behind)
+    if LEADER_ELECTION:
+        await asyncio.to_thread(leader.release)
+
+
+# UPDATE SCHEDULING
+# Updates are handled concurrently, up to UPDATE_CONCURRENCY at a time, so one manager's slow bulk accept doesn't hold
+# up everyone else. Updates from the same chat (or the same user, for updates without a chat) still run one at a time
+# in the order they arrived, which keeps ConversationHandler state consistent. Updates queued behind their own chat
+# don't take up a slot, so one busy chat can't starve the rest; UPDATE_BACKLOG bounds how many are held at once.
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', '8'))
+UPDATE_BACKLOG = int(os.getenv('UPDATE_BACKLOG', '256'))
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, concurrency, backlog):
+        # The base class only lets max_concurrent_updates in at once, so it bounds the backlog here
+        super().__init__(max(concurrency, backlog))
+        self.running = asyncio.Semaphore(concurrency)
+        self.chat_locks = {}  # key -> [lock, updates holding or waiting on it]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @staticmethod
+    def ordering_key(update):
+        if isinstance(update, Update):
+            if update.effective_chat:
+                return 'chat', update.effective_chat.id
+            if update.effective_user:
+                return 'user', update.effective_user.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        key = self.ordering_key(update)
+        if key is None:
+            async with self.running:
+                await coroutine
+            return
+
+        entry = self.chat_locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            # asyncio.Lock wakes waiters first come first served, so a chat's updates keep their order
+            async with entry[0]:
+                async with self.running:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.chat_locks[key]
+
+    def metrics(self):
+        return {
+            'updates_in_flight': sum(count for _, count in self.chat_locks.values()),
+            'busy_chats': len(self.chat_locks),
+        }
+
+
+update_processor = PerChatUpdateProcessor(UPDATE_CONCURRENCY, UPDATE_BACKLOG)
+
+
+# UPDATE INGESTION
+# BOT_MODE picks how updates reach the bot. 'polling' (the default) long-polls getUpdates. 'webhook' has Telegram push
+# updates to a small built-in HTTP server on PORT, which needs a public HTTPS URL (WEBHOOK_URL) in front of it, eg. the
+# platform's router. Webhook requests must carry WEBHOOK_SECRET in the X-Telegram-Bot-Api-Secret-Token header or they
+# are refused. Switching back to polling removes the webhook again.
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # eg. https://haley.example.com
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('PORT', '8443'))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+
+
+def run_bot(application):
+    if BOT_MODE == 'polling':
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
+    elif BOT_MODE == 'webhook':
+        if not WEBHOOK_URL:
+            raise SystemExit("BOT_MODE=webhook needs WEBHOOK_URL")
+        # Telegram only allows 1-256 characters of A-Z, a-z, 0-9, _ and -
+        if not WEBHOOK_SECRET or not re.fullmatch(r'[A-Za-z0-9_-]{1,256}', WEBHOOK_SECRET):
+            raise SystemExit("BOT_MODE=webhook needs WEBHOOK_SECRET (1-256 characters of A-Z, a-z, 0-9, _ or -)")
+        application.run_webhook(listen=WEBHOOK_LISTEN,
+                                port=WEBHOOK_PORT,
+                                url_path=WEBHOOK_PATH,
+                                webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                                secret_token=WEBHOOK_SECRET,
+                                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                                allowed_updates=Update.ALL_TYPES)
+    else:
+        raise SystemExit(f"Unknown BOT_MODE {BOT_MODE!r}, expected 'polling' or 'webhook'")
+
+
+# LEADER ELECTION
+# With LEADER_ELECTION=1 several instances of the bot can run at once. They all wait on a MySQL advisory lock
+# (GET_LOCK) before starting, and only the holder goes on to poll or serve the webhook; the rest stand by. A standby
+# that takes over loads conversations and user_data from the database as it starts, so it picks up where the last
+# leader's persistence left off.
+# The lock lives on its own connection with a wait_timeout of LEADER_LEASE seconds, which the leader's heartbeat keeps
+# from expiring. If the leader dies, or can't reach the database, the server drops its session and the lock within
+# LEADER_LEASE seconds. A leader that finds the lock gone, or can't check it for long enough that the lease might run
+# out before its next check, stops without writing its state (a new leader may already own it) and exits, so its
+# platform restarts it as a standby.
+LEADER_ELECTION = os.getenv('LEADER_ELECTION', '0') == '1'
+LEADER_LEASE = int(os.getenv('LEADER_LEASE', '15'))
+LEADER_HEARTBEAT = float(os.getenv('LEADER_HEARTBEAT', '5'))
+
+
+class LeaderElection:
+    def __init__(self, lock_name, lease, heartbeat, **connect_args):
+        self.lock_name = lock_name
+        self.lease = lease
+        self.heartbeat = heartbeat
+        self.connect_args = connect_args
+        # A check gives up after query_timeout, and the leader steps down once it has gone step_down_after seconds
+        # without a good one. The last failing check ends within heartbeat + query_timeout of that, so the leader
+        # has stopped before the server's wait_timeout (the lease) can free the lock for a standby.
+        self.query_timeout = max(1, int(heartbeat / 2))
+        self.step_down_after = lease - heartbeat - self.query_timeout
+        self.connection = None
+        self.last_checked = None  # when the last check that found the lock held was sent
+        self.lost = threading.Event()
+        self.stopped = threading.Event()
+        self.heartbeat_thread = None
+
+    def _connect(self):
+        # A stuck query gives up well before the lease runs out
+        connection = mysql.connector.connect(connection_timeout=self.query_timeout, **self.connect_args)
+        cursor = connection.cursor()
+        cursor.execute(f"SET SESSION wait_timeout = {int(self.lease)}")
+        cursor.close()
+        return connection
+
+    def _query(self, query, params):
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(query, params)
+            return cursor.fetchone()[0]
+        finally:
+            cursor.close()
+
+    def acquire(self):
+        # Blocks until this instance is the leader
+        if self.step_down_after <= 0:
+            raise SystemExit(f"LEADER_LEASE ({self.lease}s) must be longer than LEADER_HEARTBEAT plus the"
+                             f" {self.query_timeout}s query timeout")
+        standing_by = False
+        while True:
+            try:
+                if self.connection is None:
+                    self.connection = self._connect()
+                # Polled rather than waited on server side, a wait would outlast the socket's query_timeout
+                started = time.monotonic()
+                if self._query("SELECT GET_LOCK(%s, 0)", (self.lock_name,)) == 1:
+                    self.last_checked = started
+                    logger.info("This instance is the leader")
+                    return
+                if not standing_by:
+                    logger.info("Another instance is leading, standing by")
+                    standing_by = True
+                time.sleep(self.heartbeat)
+            except Error as e:
+                print(f"Error during leader election: {e}")
+                self.connection = None
+                time.sleep(self.heartbeat)
+
+    def keep_alive(self, on_lost):
+        def beat():
+            while not self.stopped.wait(self.heartbeat):
+                # Timed from when the check was sent, the server's idle clock restarts no earlier than that
+                started = time.monotonic()
+                try:
+                    held = self._query("SELECT IS_USED_LOCK(%s) = CONNECTION_ID()", (self.lock_name,)) == 1
+                    self.last_checked = started
+                except Error as e:
+                    # A short blip doesn't cost the lock, step down while there is still margin before the lease ends
+                    print(f"Error checking leadership: {e}")
+                    held = time.monotonic() - self.last_checked < self.step_down_after
+                if not held:
+                    logger.error("Lost leadership, stopping")
+                    self.lost.set()
+                    on_lost()
+                    return
+
+        self.heartbeat_thread = threading.Thread(target=beat, name='leader-heartbeat', daemon=True)
+        self.heartbeat_thread.start()
+
+    def release(self):
+        self.stopped.set()
+        if self.heartbeat_thread is not None:
+            self.heartbeat_thread.join()
+        if self.connection is not None:
+            # Closing the session frees the lock even if RELEASE_LOCK doesn't get through
+            try:
+                self._query("SELECT RELEASE_LOCK(%s)", (self.lock_name,))
+            except Error:
+                pass
+            self.connection.close()
+            self.connection = None
+
+
+leader = LeaderElection(f"haley:leader:{TOKEN.split(':')[0]}", LEADER_LEASE, LEADER_HEARTBEAT, **db_pool.connect_args)
+
+
 # MAIN BOT FUNCTION
 def main():
-    application = Application.builder().token(TOKEN).build()
+    # Standby instances wait here until they become the leader
+    if LEADER_ELECTION:
+        leader.acquire()
+
+    application = Application.builder().token(TOKEN).concurrent_updates(update_processor).persistence(persistence) \
+        .post_init(on_startup).post_shutdown(on_shutdown).build()
+
+    # Keep the in-memory caches in step with the database
+    run_every(ROLE_CACHE_TTL, lambda: run_db(role_cache.load))
+    run_every(REGISTERED_REFRESH_INTERVAL, lambda: run_db(registered_users.refresh))
+    run_every(DRAFT_SWEEP_INTERVAL, sweep_registration_drafts)
+    run_every(CONVERSATION_SWEEP_INTERVAL, lambda: sweep_user_data(application))
+    # Write staged conversation state out in batches
+    run_every(PERSISTENCE_INTERVAL, persistence.write_behind)
+    # Check training hours totals against the ledger, a batch at a time
+    run_every(HOURS_RECONCILE_INTERVAL, reconcile_hours)
+
+    # Stamp every update so idle users can be found, before any other handler sees it
+    application.add_handler(TypeHandler(Update, touch_conversation), group=-1)
 
     # Add Command Handlers
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler('setrole', set_user_role))
     application.add_handler(CommandHandler('managerisme', manager_home))
     application.add_handler(CommandHandler('seephoto', send_user_photo))
+    application.add_handler(CommandHandler('dbstats', db_stats))
+    application.add_handler(CommandHandler('statestats', state_stats))
 
     application.add_handler(MessageHandler(filters.Text(["Head Trainer Options"]), head_trainer_options))
 
     # Add Conversation Handlers (Commands below)
     conv_handler = ConversationHandler(
+        name='registration',
+        persistent=True,
+        conversation_timeout=conversation_timeout('registration', 1800),
         entry_points=[CallbackQueryHandler(register, pattern='^register$')],
         states={
             FIRST_NAME: [
@@ -2235,11 +3988,15 @@ def main():
                 CallbackQueryHandler(handle_reg_confirm, pattern='^confirm_reg$'),
                 CallbackQueryHandler(handle_reg_cancel, pattern='^cancel_reg$')
             ],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, registration_timed_out)],
         },
         fallbacks=[CommandHandler('cancel', cancel)]
     )
 
     addprog_handler = ConversationHandler(
+        name='add_programme',
+        persistent=True,
+        conversation_timeout=conversation_timeout('add_programme', 1800),
         entry_points=[CallbackQueryHandler(start_addprog, pattern='^add_prog$')],
         states={
             SCHOOL: [MessageHandler(filters.TEXT & ~filters.COMMAND, school)],
@@ -2258,6 +4015,9 @@ def main():
     )
 
     joblist_handler = ConversationHandler(
+        name='list_programmes',
+        persistent=True,
+        conversation_timeout=conversation_timeout('list_programmes', 600),
         entry_points=[CallbackQueryHandler(list_jobs, pattern='^list$')],
         states={
             SELECT_DATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, select_date)],
@@ -2266,6 +4026,9 @@ def main():
     )
 
     applications_handler = ConversationHandler(
+        name='applications',
+        persistent=True,
+        conversation_timeout=conversation_timeout('applications', 1800),
         entry_points=[CallbackQueryHandler(view_applications, pattern='^view_app$')],
         states={
             ACCEPT_OR_REJECT: [CallbackQueryHandler(app_accept_button, pattern='^accept_app$'),
@@ -2277,6 +4040,9 @@ def main():
     )
 
     signup_handler = ConversationHandler(
+        name='signup',
+        persistent=True,
+        conversation_timeout=conversation_timeout('signup', 900),
         entry_points=[CallbackQueryHandler(apply_job_handler, pattern='^signup$')],
         states={
             APPLY_JOB: [MessageHandler(filters.TEXT & ~filters.COMMAND, apply_job)],
@@ -2290,6 +4056,9 @@ def main():
     )
 
     user_view_apps_handler = ConversationHandler(
+        name='manage_signups',
+        persistent=True,
+        conversation_timeout=conversation_timeout('manage_signups', 900),
         entry_points=[CallbackQueryHandler(view_user_apps, pattern='^myprog$')],
         states={
             USER_OPTIONS: [CallbackQueryHandler(handle_go_home, pattern='^go_home1$'),
@@ -2303,6 +4072,9 @@ def main():
     )
 
     completions_handler = ConversationHandler(
+        name='complete_programme',
+        persistent=True,
+        conversation_timeout=conversation_timeout('complete_programme', 1800),
         entry_points=[CallbackQueryHandler(complete_prog, pattern='^complete_programme$')],
         states={
             COMPLETE_OR_CANCEL: [CallbackQueryHandler(yes_complete_handle, pattern='^yes_complete$'),
@@ -2314,6 +4086,9 @@ def main():
         fallbacks=[CommandHandler('cancel', cancel)]
     )
 
+    # Prev/Next on paginated listings, ahead of the conversations so it works whatever state they are in
+    application.add_handler(CallbackQueryHandler(turn_page, pattern='^page:'))
+
     # Add Conversation Commands
     application.add_handler(conv_handler)
     application.add_handler(addprog_handler)
@@ -2323,15 +4098,23 @@ def main():
     application.add_handler(user_view_apps_handler)
     application.add_handler(completions_handler)
 
+    # Keep the membership cache fresh as people join or leave the associates group
+    application.add_handler(ChatMemberHandler(track_associate_membership, ChatMemberHandler.CHAT_MEMBER))
+
     # Add CallbackQueryHandler for handling inline keyboard interactions
     application.add_handler(CallbackQueryHandler(handle_callback_query))
 
+    # Report DB timeouts back to the user instead of leaving them hanging
+    application.add_error_handler(error_handler)
+
     # Add default message handler
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE,
                                            default_response))
 
     # Start the bot
-    application.run_polling()
+    run_bot(application)
+    if leader.lost.is_set():
+        raise SystemExit("Stopped after losing leadership")
 
 
 if __name__ == '__main__':
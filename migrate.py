@@ -0,0 +1,204 @@
+import argparse
+import asyncio
+from mysql.connector import Error
+from telegram.error import RetryAfter, TelegramError
+from main import ADMIN_USER_ID, bot, create_db_connection, photo_store
+
+# Schema changes, applied in order and recorded in schema_migrations so each one only ever runs once.
+# Usage: python migrate.py schema
+MIGRATIONS = [
+    ('0001_users_photo_ref', [
+        """
+        ALTER TABLE users
+            ADD COLUMN photo_ref CHAR(64) NULL,
+            ADD COLUMN photo_file_id VARCHAR(255) NULL
+        """,
+    ]),
+    # Programme listing: equality on job_status, range on prog_date, trainers_needed checked from the index
+    ('0002_jobs_listing_index', [
+        "CREATE INDEX idx_jobs_listing ON jobs (job_status, prog_date, trainers_needed)",
+    ]),
+    # Conversation states, user_data and registration drafts written by the bot's persistence
+    ('0003_bot_state', [
+        """
+        CREATE TABLE bot_state (
+            kind VARCHAR(64) NOT NULL,
+            state_key VARCHAR(128) NOT NULL,
+            data MEDIUMTEXT NOT NULL,
+            updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+            PRIMARY KEY (kind, state_key)
+        )
+        """,
+    ]),
+    # Training hours ledger and per-trainer totals, opened with each trainer's hours so far
+    ('0004_hours_ledger', [
+        """
+        CREATE TABLE hours_ledger (
+            entry_id BIGINT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+            uid INT NOT NULL,
+            session_id INT NULL,
+            hours DECIMAL(6, 2) NOT NULL,
+            note VARCHAR(255) NULL,
+            credited_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE KEY uq_hours_ledger_credit (uid, session_id),
+            KEY idx_hours_ledger_history (uid, entry_id),
+            KEY idx_hours_ledger_session (session_id)
+        )
+        """,
+        """
+        CREATE TABLE hours_totals (
+            uid INT NOT NULL PRIMARY KEY,
+            total_hours DECIMAL(10, 2) NOT NULL DEFAULT 0,
+            entries INT NOT NULL DEFAULT 0,
+            last_entry_id BIGINT NOT NULL DEFAULT 0
+        )
+        """,
+        """
+        INSERT INTO hours_ledger (uid, session_id, hours, note)
+        SELECT uid, NULL, training_hours, 'Hours before the ledger' FROM users WHERE training_hours <> 0
+        """,
+        """
+        INSERT INTO hours_totals (uid, total_hours, entries, last_entry_id)
+        SELECT uid, SUM(hours), COUNT(*), MAX(entry_id) FROM hours_ledger GROUP BY uid
+        """,
+    ]),
+    # One application per user per programme. Duplicates left by the old check-then-insert are dropped first, keeping
+    # the one that matters most (accepted, then removed, pending, rejected, withdrawn; newest first). The table is
+    # rebuilt rather than deleted from, and the original is kept as applications_before_0005. Stop the bot first.
+    ('0005_applications_unique_signup', [
+        "CREATE TABLE applications_dedup LIKE applications",
+        "ALTER TABLE applications_dedup ADD UNIQUE KEY uq_applications_signup (telegram_id, session_id)",
+        """
+        INSERT IGNORE INTO applications_dedup
+        SELECT * FROM applications
+        ORDER BY FIELD(app_status, 'withdrawn', 'rejected', 'pending', 'removed', 'accepted') DESC, apply_time DESC
+        """,
+        "RENAME TABLE applications TO applications_before_0005, applications_dedup TO applications",
+    ]),
+    # The listing pages by (prog_date, session_id). With trainers_needed in between, 0002's index didn't give rows in
+    # that order, so each page sorted the whole month again. InnoDB appends the primary key (session_id) to the index.
+    ('0006_jobs_listing_index_keyset', [
+        "ALTER TABLE jobs DROP INDEX idx_jobs_listing, ADD INDEX idx_jobs_listing (job_status, prog_date)",
+    ]),
+]
+
+
+def migrate_schema():
+    connection = create_db_connection()
+    if connection is None:
+        print("Failed to connect to the database")
+        return
+    cursor = None
+    try:
+        cursor = connection.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                name VARCHAR(100) PRIMARY KEY,
+                applied_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        cursor.execute("SELECT name FROM schema_migrations")
+        applied = {row[0] for row in cursor.fetchall()}
+
+        for name, statements in MIGRATIONS:
+            if name in applied:
+                continue
+            print(f"Applying {name}")
+            for statement in statements:
+                cursor.execute(statement)
+            cursor.execute("INSERT INTO schema_migrations (name) VALUES (%s)", (name,))
+            connection.commit()
+        print("Schema is up to date.")
+    except Error as e:
+        print("Error while migrating schema", e)
+    finally:
+        if cursor is not None:
+            cursor.close()
+        connection.close()
+
+
+# Moves registration photos out of users.photo into the photo store, a batch at a time so only one batch of BLOBs is
+# ever in memory. The store is local disk, which Heroku wipes on restart, so a BLOB is only cleared once Telegram holds
+# the photo too: each one is sent to the admin chat for its file_id (the message is deleted again, the file_id stays
+# valid). A photo that can't be uploaded keeps its BLOB and is retried on the next run.
+# Usage: python migrate.py photos [--batch-size 50]
+async def upload_photo(photo):
+    while True:
+        try:
+            message = await bot.send_photo(chat_id=ADMIN_USER_ID, photo=photo, disable_notification=True)
+            break
+        except RetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+    try:
+        await message.delete()
+    except TelegramError:
+        pass
+    return message.photo[-1].file_id
+
+
+async def migrate_photos(batch_size):
+    connection = create_db_connection()
+    if connection is None:
+        print("Failed to connect to the database")
+        return
+    cursor = None
+    last_uid = 0
+    moved = 0
+    kept = 0
+    try:
+        cursor = connection.cursor()
+        async with bot:
+            while True:
+                cursor.execute("""
+                    SELECT uid, photo FROM users
+                    WHERE uid > %s AND photo IS NOT NULL AND photo_ref IS NULL
+                    ORDER BY uid
+                    LIMIT %s
+                """, (last_uid, batch_size))
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+
+                updates = []
+                for uid, photo in rows:
+                    photo = bytes(photo)
+                    try:
+                        file_id = await upload_photo(photo)
+                    except TelegramError as e:
+                        print(f"Could not upload the photo for uid {uid}, keeping it in the table: {e}")
+                        kept += 1
+                        continue
+                    updates.append((photo_store.put_bytes(photo), file_id, uid))
+                if updates:
+                    cursor.executemany("UPDATE users SET photo_ref = %s, photo_file_id = %s, photo = NULL"
+                                       " WHERE uid = %s", updates)
+                    connection.commit()
+
+                last_uid = rows[-1][0]
+                moved += len(updates)
+                print(f"Moved {moved} photo(s), up to uid {last_uid}")
+        print(f"Done. {moved} photo(s) moved to {photo_store.root}, {kept} left in the table.")
+    except Error as e:
+        print("Error while migrating photos", e)
+    finally:
+        if cursor is not None:
+            cursor.close()
+        connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Database migrations for Haley")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('schema', help="apply pending schema migrations")
+    photos_parser = subparsers.add_parser('photos', help="move photo BLOBs out of the users table")
+    photos_parser.add_argument('--batch-size', type=int, default=50)
+    args = parser.parse_args()
+
+    if args.command == 'schema':
+        migrate_schema()
+    elif args.command == 'photos':
+        asyncio.run(migrate_photos(args.batch_size))
+
+
+if __name__ == '__main__':
+    main()